@@ -0,0 +1,234 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# batch.py
+#  - evaluation of expressions on many branches at once with numpy
+#
+# Integer values are int64 arrays in the column encoding of columns.py,
+# (magnitude << 1) | sign bit, so +0 and -0 stay distinct. Float values
+# are float64 arrays. Whenever numpy can't reproduce the result of
+# evaluating branch by branch (overflow, division by zero, domain errors)
+# a BatchError is raised and the caller falls back to per-branch evaluation.
+
+max_mag = 2**62 - 1
+
+class BatchError(Exception):
+    pass
+
+############################ Conversions
+
+def fits(vals):
+    if len(vals) > 0 and np.abs(vals).max() > max_mag:
+        raise BatchError("Value too large for batch evaluation.")
+    return vals
+
+def from_ints(vals):
+    return (np.abs(vals) << 1) | (vals < 0)
+
+# results of round, floor, ceil
+def from_floats(vals):
+    return from_ints(fits(check(vals)).astype(np.int64))
+
+def to_ints(enc):
+    return (enc >> 1) * (1 - 2*(enc & 1))
+
+def to_floats(vals, isfloat):
+    if isfloat: return vals
+    return to_ints(vals).astype(np.float64)
+
+# es_int(float): truncates, and keeps the sign of -0.0
+def float_to_enc(vals):
+    fits(check(vals))
+    return (np.trunc(np.abs(vals)).astype(np.int64) << 1) | np.signbit(vals)
+
+def to_enc(vals, isfloat):
+    if isfloat: return float_to_enc(vals)
+    return vals
+
+def constant(val, n):
+    if isinstance(val, float): return np.full(n, val, dtype=np.float64)
+    if val.mag > max_mag: raise BatchError("Value too large for batch evaluation.")
+    return np.full(n, (val.mag << 1) | (1 if val.sign < 0 else 0), dtype=np.int64)
+
+def check(vals):
+    if not np.isfinite(vals).all():
+        raise BatchError("Non-finite value in batch evaluation.")
+    return vals
+
+def nonzero(vals):
+    if (vals == 0).any(): raise BatchError("Division by zero in batch evaluation.")
+    return vals
+
+def bools(vals):
+    return vals.astype(np.int64) << 1
+
+############################ Binary operations
+
+# Each takes the two operand arrays, and returns an array of the result.
+# Float operations are used whenever the result is a float, in which case
+# both operands were cast to float. Integer operations receive the
+# operands as they are, which matters for comparisons and bitwise
+# operations with a float operand.
+
+float_ops = {
+    "add": lambda x,y: x + y,
+    "sub": lambda x,y: x - y,
+    "mul": lambda x,y: x * y,
+    "truediv": lambda x,y: x / nonzero(y),
+    "floordiv": lambda x,y: x // nonzero(y),
+    "mod": lambda x,y: x % nonzero(y),
+    "pow": lambda x,y: x ** y,
+}
+
+def int_arith(f):
+    def g(x, y):
+        x, y = to_ints(x), to_ints(y)
+        fits(f(x.astype(float), y.astype(float)))
+        return from_ints(f(x, y))
+    return g
+
+def shift(left):
+    def g(x, y):
+        mag, sign, y = x >> 1, 1 - 2*(x & 1), to_ints(y)
+        if (y < 0).any(): raise BatchError("Negative shift count.")
+        y = np.minimum(y, 63)
+        if left:
+            if ((mag >> np.maximum(62 - y, 0)) != 0).any():
+                raise BatchError("Value too large for batch evaluation.")
+            return from_ints(sign*(mag << y))
+        return from_ints(sign*(mag >> y))
+    return g
+
+def getitem(x, y):
+    y = to_ints(y)
+    if (y < -1).any(): raise BatchError("Negative bit index.")
+    return bools((x >> np.minimum(y + 1, 63)) & 1)
+
+def xor(x, y):
+    return from_ints(((x >> 1) ^ (y >> 1)) * (1 - 2*(x & 1)) * (1 - 2*(y & 1)))
+
+int_ops = {
+    "add": int_arith(lambda x,y: x + y),
+    "sub": int_arith(lambda x,y: x - y),
+    "mul": int_arith(lambda x,y: x * y),
+    "floordiv": lambda x,y: from_ints(to_ints(x) // nonzero(to_ints(y))),
+    "mod": lambda x,y: from_ints(to_ints(x) % nonzero(to_ints(y))),
+    "lshift": shift(True),
+    "rshift": shift(False),
+    "and": lambda x,y: ((x >> 1) & (y >> 1)) << 1,
+    "or": lambda x,y: ((x >> 1) | (y >> 1)) << 1,
+    "xor": xor,
+    "getitem": getitem,
+    "lt": lambda x,y: bools(to_ints(x) < to_ints(y)),
+    "le": lambda x,y: bools(to_ints(x) <= to_ints(y)),
+    "gt": lambda x,y: bools(to_ints(x) > to_ints(y)),
+    "ge": lambda x,y: bools(to_ints(x) >= to_ints(y)),
+    "eq": lambda x,y: bools(x == y),
+    "ne": lambda x,y: bools(x != y),
+}
+
+compare_ops = {
+    "lt": lambda x,y: bools(x < y),
+    "le": lambda x,y: bools(x <= y),
+    "gt": lambda x,y: bools(x > y),
+    "ge": lambda x,y: bools(x >= y),
+    "eq": lambda x,y: bools(x == y),
+    "ne": lambda x,y: bools(x != y),
+}
+
+# integer operations where a float operand is cast like es_int(float), when
+# the other operand is an integer. On two floats only comparisons are defined.
+float_casting = ["and", "or", "xor", "lt", "le", "gt", "ge", "eq", "ne"]
+
+def binary(name):
+    swap = name in ["rtruediv", "rfloordiv", "rmod", "rlshift", "rrshift"]
+    if swap: name = name[1:]
+
+    def f(x, xfloat, y, yfloat, outfloat):
+        if swap: x, xfloat, y, yfloat = y, yfloat, x, xfloat
+
+        if outfloat:
+            if name not in float_ops: raise BatchError("No float batch operation "+name+".")
+            return check(float_ops[name](to_floats(x, xfloat), to_floats(y, yfloat)))
+
+        if xfloat and yfloat and name in compare_ops:
+            return compare_ops[name](x, y)
+        if xfloat and yfloat: raise BatchError("No float batch operation "+name+".")
+        if xfloat or yfloat:
+            if name not in float_casting: raise BatchError("No float batch operation "+name+".")
+            x, y = to_enc(x, xfloat), to_enc(y, yfloat)
+        return int_ops[name](x, y)
+
+    return f
+
+############################ Unary operations
+
+def bit_length(mag):
+    out = np.zeros(len(mag), dtype=np.int64)
+    for s in [32, 16, 8, 4, 2, 1]:
+        big = mag >= (1 << s)
+        out += np.where(big, s, 0)
+        mag = np.where(big, mag >> s, mag)
+    return out + (mag > 0)
+
+int_unary = {
+    "neg": lambda x: x ^ 1,
+    "abs": lambda x: (x >> 1) << 1,
+    "len": lambda x: from_ints(bit_length(x >> 1)),
+    "int": lambda x: x,
+    "float": lambda x: to_floats(x, False),
+}
+
+float_unary = {
+    "neg": lambda x: -x,
+    "abs": lambda x: np.abs(x),
+    "int": float_to_enc,
+    "float": lambda x: x,
+    "round": lambda x: from_floats(np.round(x)),
+    "floor": lambda x: from_floats(np.floor(x)),
+    "ceil": lambda x: from_floats(np.ceil(x)),
+}
+
+def float_fn(f): return lambda x: check(f(x))
+
+if np is not None:
+    float_unary.update({
+        "sin": float_fn(np.sin),
+        "cos": float_fn(np.cos),
+        "tan": float_fn(np.tan),
+        "asin": float_fn(np.arcsin),
+        "acos": float_fn(np.arccos),
+        "atan": float_fn(np.arctan),
+        "sqrt": float_fn(np.sqrt),
+        "exp": float_fn(np.exp),
+    })
+
+def unary(name):
+    def f(x, xfloat):
+        if name in ["sin", "cos", "tan", "asin", "acos", "atan", "sqrt", "exp"]:
+            x, xfloat = to_floats(x, xfloat), True
+        if xfloat: return float_unary[name](x)
+        return int_unary[name](x)
+    return f
+
+############################ QRAM
+
+# dictionary maps int keys to expressions with a batch method v
+def qram(index, cols, dictionary, outfloat):
+    index = to_ints(index)
+    out = np.zeros(len(index), dtype=np.float64 if outfloat else np.int64)
+
+    found = np.zeros(len(index), dtype=bool)
+    for key, expr in dictionary.items():
+        if abs(int(key)) > max_mag: continue
+        where = index == int(key)
+        if not where.any(): continue
+        found |= where
+        if expr.v is None: raise BatchError("QRAM value can't be evaluated in batch.")
+        val = expr.v(cols)[where]
+        out[where] = to_floats(val, expr.float) if outfloat else to_enc(val, expr.float)
+
+    if not found.all(): raise BatchError("QRAM key missing.")
+    return out
@@ -0,0 +1,307 @@
+import math
+from functools import partial
+from . import qvars
+
+# codegen.py
+#  - compiles the tree of an Expression into one flat python function
+#
+# Trees are tuples (name, float, *children). Leaves are
+#   ("reg", False, key), ("const", float, value), ("opaque", float, expr)
+# where an opaque leaf is any expression without a tree, evaluated with expr.c.
+#
+# The compiled function evaluates the whole tree on a branch with native ints,
+# and only builds an es_int for the result. An int value lives in one or more
+# local variables of these kinds:
+#   O: es_int,  S: signed int,  E: (magnitude << 1) | sign bit, which keeps -0,
+#   M: magnitude,  N: sign bit,  F: float,  X: raw value of an opaque leaf.
+# Values are only converted to the kinds an operation needs.
+
+def decode(enc):
+    return qvars.es_int.signed(-1 if enc & 1 else 1, enc >> 1)
+
+def cast(val):
+    if isinstance(val, qvars.es_int): return val
+    return qvars.es_int(val)
+
+# operations on python objects, used when an operand isn't an int
+binary_py = {
+    "add": lambda x,y: x+y,
+    "sub": lambda x,y: x-y,
+    "mul": lambda x,y: x*y,
+    "truediv": lambda x,y: x / y,
+    "floordiv": lambda x,y: x // y,
+    "mod": lambda x,y: x % y,
+    "rtruediv": lambda x,y: y / x,
+    "rfloordiv": lambda x,y: y // x,
+    "rmod": lambda x,y: y % x,
+    "pow": lambda x,y: x**y,
+    "lshift": lambda x,y: x << y,
+    "rshift": lambda x,y: x >> y,
+    "and": lambda x,y: x & y,
+    "xor": lambda x,y: x ^ y,
+    "or": lambda x,y: x | y,
+    "rlshift": lambda x,y: y << x,
+    "rrshift": lambda x,y: y >> x,
+    "getitem": lambda x,y: x[y],
+    "lt": lambda x,y: qvars.es_int(x < y),
+    "le": lambda x,y: qvars.es_int(x <= y),
+    "gt": lambda x,y: qvars.es_int(x > y),
+    "ge": lambda x,y: qvars.es_int(x >= y),
+    "eq": lambda x,y: qvars.es_int(x == y),
+    "ne": lambda x,y: qvars.es_int(x != y),
+}
+
+unary_py = {
+    "neg": lambda x: -x,
+    "abs": lambda x: abs(x),
+    "len": lambda x: qvars.es_int(len(x)),
+    "int": lambda x: qvars.es_int(x),
+    "float": lambda x: float(x),
+    "round": lambda x: qvars.es_int(round(x)),
+    "floor": lambda x: qvars.es_int(math.floor(x)),
+    "ceil": lambda x: qvars.es_int(math.ceil(x)),
+    "sin": lambda x: math.sin(float(x)),
+    "cos": lambda x: math.cos(float(x)),
+    "tan": lambda x: math.tan(float(x)),
+    "asin": lambda x: math.asin(float(x)),
+    "acos": lambda x: math.acos(float(x)),
+    "atan": lambda x: math.atan(float(x)),
+    "sqrt": lambda x: math.sqrt(float(x)),
+    "exp": lambda x: math.exp(float(x)),
+}
+
+# on ints, in terms of the signed values
+arith = {"add": "{x} + {y}", "sub": "{x} - {y}", "mul": "{x} * {y}",
+        "floordiv": "{x} // {y}", "mod": "{x} % {y}",
+        "rfloordiv": "{y} // {x}", "rmod": "{y} % {x}",
+        "lt": "1 if {x} < {y} else 0", "le": "1 if {x} <= {y} else 0",
+        "gt": "1 if {x} > {y} else 0", "ge": "1 if {x} >= {y} else 0"}
+
+# on floats, any result of pow may also be complex
+float_arith = {"add": "{x} + {y}", "sub": "{x} - {y}", "mul": "{x} * {y}",
+        "truediv": "{x} / {y}", "floordiv": "{x} // {y}", "mod": "{x} % {y}",
+        "rtruediv": "{y} / {x}", "rfloordiv": "{y} // {x}", "rmod": "{y} % {x}",
+        "pow": "{x} ** {y}"}
+
+float_fns = ["sin", "cos", "tan", "asin", "acos", "atan", "sqrt", "exp"]
+
+
+class Value():
+    def __init__(self, isfloat, **kinds):
+        self.float = isfloat
+        self.kinds = kinds   # kind -> local variable
+
+
+class Codegen():
+    def __init__(self):
+        self.lines = []
+        self.params = []
+        self.args = []
+        self.regs = {} # key -> value loaded from the branch
+
+    def param(self, arg):
+        name = "p"+str(len(self.params))
+        self.params.append(name)
+        self.args.append(arg)
+        return name
+
+    def temp(self, code):
+        name = "t"+str(len(self.lines))
+        self.lines.append(name+" = "+code)
+        return name
+
+    # a local variable holding val as the given kind
+    def get(self, val, kind):
+        k = val.kinds
+        if kind in k: return k[kind]
+
+        if val.float:
+            if kind == "F": code = "float("+k["X"]+")"
+            elif kind == "X": return k["F"]
+            else: raise ValueError
+        elif "O" not in k and "X" in k and kind not in ["X"]:
+            k["O"] = self.temp("cast("+k["X"]+")")
+            return self.get(val, kind)
+        elif kind == "X": return self.get(val, "O")
+        elif kind == "S":
+            if "O" in k: code = k["O"]+".sign * "+k["O"]+".mag"
+            else:
+                m, n = self.get(val, "M"), self.get(val, "N")
+                code = "-"+m+" if "+n+" else "+m
+        elif kind == "M":
+            if "O" in k: code = k["O"]+".mag"
+            elif "E" in k: code = k["E"]+" >> 1"
+            else: code = "abs("+k["S"]+")"
+        elif kind == "N":
+            if "O" in k: code = "1 if "+k["O"]+".sign < 0 else 0"
+            elif "E" in k: code = k["E"]+" & 1"
+            else: code = "1 if "+k["S"]+" < 0 else 0"
+        elif kind == "E":
+            code = "("+self.get(val, "M")+" << 1) | "+self.get(val, "N")
+        elif kind == "O":
+            if "E" in k: code = "decode("+k["E"]+")"
+            else: code = "es_int("+k["S"]+")"
+        elif kind == "F": code = "float("+self.get(val, "S")+")"
+        else: raise ValueError
+
+        k[kind] = self.temp(code)
+        return k[kind]
+
+    # the value as a python object, as the per-branch operations see it
+    def obj(self, val):
+        if val.float: return self.get(val, "X")
+        return self.get(val, "O")
+
+    def generic(self, table, name, *vals):
+        f = self.param(table[name])
+        return self.temp(f+"("+", ".join(self.obj(val) for val in vals)+")")
+
+    def node(self, tree):
+        name, isfloat = tree[0], tree[1]
+
+        if name == "reg":
+            key = tree[2].key
+            if key not in self.regs:
+                self.regs[key] = Value(False, O=self.temp("b["+self.param(tree[2])+".index()]"))
+            return self.regs[key]
+        if name == "const":
+            val = tree[2]
+            if not isfloat:
+                sign = 1 if val.sign < 0 else 0
+                return Value(False, E=self.param((val.mag << 1) | sign), S=self.param(int(val)),
+                        M=self.param(val.mag), N=self.param(sign))
+            if type(val) is float: return Value(True, F=self.param(val))
+            return Value(True, X=self.param(val))
+        if name == "opaque":
+            out = self.temp(self.param(tree[2])+".c(b)")
+            return Value(isfloat, X=out)
+
+        vals = [self.node(child) for child in tree[2:]]
+
+        if len(vals) == 2: return self.binary(name, isfloat, *vals)
+        return self.unary(name, isfloat, vals[0])
+
+    def binary(self, name, isfloat, x, y):
+        if isfloat:
+            if name not in float_arith: return Value(True, X=self.generic(binary_py, name, x, y))
+            code = float_arith[name].format(x=self.get(x, "F"), y=self.get(y, "F"))
+            if name == "pow": return Value(True, X=self.temp(code))
+            return Value(True, F=self.temp(code))
+
+        if x.float or y.float:
+            return Value(False, X=self.generic(binary_py, name, x, y))
+
+        if name in ["rlshift", "rrshift"]:
+            name, x, y = name[1:], y, x
+
+        if name in arith:
+            code = arith[name].format(x=self.get(x, "S"), y=self.get(y, "S"))
+            return Value(False, S=self.temp(code))
+
+        if name in ["lshift", "rshift"]:
+            op = " << " if name == "lshift" else " >> "
+            mag = self.temp(self.get(x, "M") + op + self.get(y, "S"))
+            return Value(False, S=self.temp("-"+mag+" if "+self.get(x, "N")+" else "+mag))
+
+        if name in ["and", "or"]:
+            op = " & " if name == "and" else " | "
+            return Value(False, S=self.temp(self.get(x, "M") + op + self.get(y, "M")))
+
+        if name == "xor":
+            mag = self.temp(self.get(x, "M") + " ^ " + self.get(y, "M"))
+            sign = self.get(x, "N") + " ^ " + self.get(y, "N")
+            return Value(False, S=self.temp("-"+mag+" if "+sign+" else "+mag))
+
+        if name in ["eq", "ne"]:
+            op = " == " if name == "eq" else " != "
+            return Value(False, S=self.temp("1 if "+self.get(x, "E") + op + self.get(y, "E")+" else 0"))
+
+        if name == "getitem":
+            # index -1 is the sign bit, which is 3 when encoded
+            code = self.get(x, "N")+" if "+self.get(y, "E")+" == 3 else ("+\
+                    self.get(x, "M")+" >> "+self.get(y, "S")+") & 1"
+            return Value(False, S=self.temp(code))
+
+        return Value(False, X=self.generic(binary_py, name, x, y))
+
+    def unary(self, name, isfloat, x):
+        if x.float:
+            if name in ["neg", "abs"]:
+                code = ("-" if name == "neg" else "abs")+"("+self.get(x, "X")+")"
+                if "X" not in x.kinds: return Value(isfloat, F=self.temp(code))
+                return Value(isfloat, X=self.temp(code))
+            if name == "float": return Value(True, F=self.get(x, "F"))
+            if name in float_fns:
+                return Value(True, F=self.temp("math."+name+"("+self.get(x, "F")+")"))
+            return Value(isfloat, X=self.generic(unary_py, name, x))
+
+        if name == "neg": return Value(False, E=self.temp(self.get(x, "E")+" ^ 1"))
+        if name == "abs": return Value(False, S=self.get(x, "M"))
+        if name == "len": return Value(False, S=self.temp(self.get(x, "M")+".bit_length()"))
+        if name == "int": return Value(False, **x.kinds)
+        if name == "float" or name in float_fns:
+            f = self.get(x, "F")
+            if name == "float": return Value(True, F=f)
+            return Value(True, F=self.temp("math."+name+"("+f+")"))
+        return Value(isfloat, X=self.generic(unary_py, name, x))
+
+    def result(self, val):
+        if val.float: return self.get(val, "X")
+        return self.get(val, "O")
+
+    def source(self, tree):
+        out = self.result(self.node(tree))
+        lines = ["def f("+", ".join(self.params + ["b"])+"):"]
+        lines += ["    "+line for line in self.lines]
+        lines.append("    return "+out)
+        return "\n".join(lines)+"\n"
+
+
+cache = {} # source -> function
+
+def compile_tree(tree):
+    gen = Codegen()
+    src = gen.source(tree)
+
+    if src not in cache:
+        namespace = {"es_int": qvars.es_int, "decode": decode, "cast": cast, "math": math}
+        exec(compile(src, "<qumquat expression>", "exec"), namespace)
+        cache[src] = namespace["f"]
+
+    return partial(cache[src], *gen.args)
+
+# evaluates a tree on one branch with the operations on python objects,
+# converting operands and results as the compiled function does. This is
+# cheaper than compiling for an expression that is only evaluated once.
+def interpret(tree, b):
+    name, isfloat = tree[0], tree[1]
+    if name == "reg": return b[tree[2].index()]
+    if name == "const": return tree[2]
+    if name == "opaque": return tree[2].c(b)
+
+    vals = [interpret(child, b) for child in tree[2:]]
+    if isfloat and (name in float_arith or name in float_fns):
+        vals = [float(val) for val in vals]
+
+    if len(vals) == 2: out = binary_py[name](*vals)
+    else: out = unary_py[name](vals[0])
+    if isfloat: return out
+    return cast(out)
+
+# evaluation function for a tree, interpreted the first time it is called
+# and compiled the second time
+def compiled(tree):
+    f = None
+    first = True
+    def c(b):
+        nonlocal f, first
+        if first:
+            first = False
+            return interpret(tree, b)
+        if f is None: f = compile_tree(tree)
+        return f(b)
+    return c
+
+# the source of the compiled function for a tree, for inspection
+def source(tree):
+    return Codegen().source(tree)
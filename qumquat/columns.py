@@ -0,0 +1,463 @@
+from .qvars import *
+import math
+
+# columns.py
+#  - set_backend
+#  - columns, set_columns, unpack_columns, state, amplitudes, select_branches
+#  - batch_values, truth_values, float_values, int_values, expression_values
+#  - restrict_mask, control_mask
+#  - alloc (materialize), alloc_inv, oper, phase, cnot, swap, had, walsh, qft, prune on columns
+
+# The numpy backend stores the state as one int64 column per register and
+# a complex128 column of amplitudes. An es_int is stored as
+# (magnitude << 1) | sign bit, so +0 and -0 stay distinct and bit i of
+# the register is bit i+1 of the column.
+
+def encode(val):
+    val = es_int(val)
+    if val.mag > batch.max_mag: raise OverflowError("Register value too large for numpy backend.")
+    return (val.mag << 1) | (1 if val.sign < 0 else 0)
+
+def decode(enc):
+    return es_int.signed(-1 if enc & 1 else 1, enc >> 1)
+
+
+class ColumnState():
+    def __init__(self, regs, amp):
+        self.regs = regs # dictionary: register -> int64 array
+        self.amp = amp   # complex128 array
+
+    def __len__(self): return len(self.amp)
+
+    # copy of the given rows, optionally only of some registers
+    def take(self, idxs, regs=None):
+        if regs is None: regs = self.regs.keys()
+        return ColumnState({reg:self.regs[reg][idxs] for reg in regs}, self.amp[idxs])
+
+    # read-only dict-like views of each branch, for evaluating expressions
+    def rows(self):
+        lists = {reg:col.tolist() for reg,col in self.regs.items()}
+        lists["amp"] = self.amp.tolist()
+        return [ColumnRow(lists, i) for i in range(len(self))]
+
+
+class ColumnRow():
+    def __init__(self, lists, i):
+        self.lists = lists
+        self.i = i
+
+    def __getitem__(self, reg):
+        if reg == "amp": return self.lists["amp"][self.i]
+        return decode(self.lists[reg][self.i])
+
+
+class Columns:
+
+    backend = "python"
+
+    def set_backend(self, backend):
+        if backend not in ["python", "numpy"]:
+            raise ValueError("Unknown backend "+str(backend)+", use 'python' or 'numpy'.")
+        if backend == "numpy": self.get_numpy("numpy backend")
+
+        self.branch_list() # unpack columns, if any
+        self.backend = backend
+
+    # returns the state as a ColumnState if the numpy backend is active
+    # and all register values fit in the columns, None otherwise
+    def columns(self):
+        if self.backend != "numpy": return None
+        if self._columns is None:
+            try: self._columns = self.pack_columns(self._branches)
+            except OverflowError: return None
+            self._branches = None
+        return self._columns
+
+    # the ColumnState if there is one, otherwise the list of branches
+    def state(self):
+        cols = self.columns()
+        if cols is not None: return cols
+        return self.branch_list()
+
+    # pack some or all registers of a list of branches into columns
+    def pack_columns(self, branches, regs=None):
+        np = self.get_numpy("numpy backend")
+        n = len(branches)
+        if regs is None: regs = [reg for reg in branches[0].keys() if reg != "amp"]
+
+        cols = {}
+        for reg in regs:
+            cols[reg] = np.fromiter((encode(b[reg]) for b in branches), dtype=np.int64, count=n)
+        amp = np.fromiter((b["amp"] for b in branches), dtype=np.complex128, count=n)
+        return ColumnState(cols, amp)
+
+    def unpack_columns(self, cols):
+        branches = [{"amp": a} for a in cols.amp.tolist()]
+        for reg, col in cols.regs.items():
+            for b, enc in zip(branches, col.tolist()): b[reg] = decode(enc)
+        return branches
+
+    # replace the state with columns having different rows
+    def set_columns(self, cols):
+        self._columns = cols
+        self.branch_version += 1
+
+    # keep the branches at the given indices, dividing amplitudes by norm
+    def select_branches(self, idxs, norm=1):
+        cols = self.columns()
+        if cols is not None:
+            np = self.get_numpy("numpy backend")
+            self.set_columns(cols.take(np.array(idxs, dtype=np.int64)))
+            self._columns.amp /= norm
+            return
+
+        branches = self.branch_list()
+        self.branches = [branches[i] for i in idxs]
+        for branch in self.branch_list():
+            branch["amp"] /= norm
+
+    # amplitudes of a ColumnState or a list of branches, as a list
+    def amplitudes(self, branches):
+        if isinstance(branches, ColumnState): return branches.amp.tolist()
+        return [b["amp"] for b in branches]
+
+    ################### Evaluating expressions
+
+    def expr_regs(self, expr):
+        return [Key(self, val=k).index() for k in expr.keys]
+
+    # values of expr on branches (a ColumnState or a list of at least
+    # batch_size branches) evaluated all at once: an int64 array in the
+    # column encoding, or a float64 array. None if this isn't possible.
+    def batch_values(self, expr, branches):
+        if batch.np is None or getattr(expr, "v", None) is None: return None
+
+        if not isinstance(branches, ColumnState):
+            if len(branches) < self.batch_size: return None
+            try: branches = self.pack_columns(branches, self.expr_regs(expr))
+            except OverflowError: return None
+
+        try:
+            with batch.np.errstate(all="ignore"): return expr.v(branches)
+        except BatchError: return None
+
+    def rows(self, branches):
+        if isinstance(branches, ColumnState): return branches.rows()
+        return branches
+
+    # expr != 0 on each branch, as a list
+    def truth_values(self, expr, branches):
+        vals = self.batch_values(expr, branches)
+        if vals is not None: return (vals != 0).tolist()
+        return [expr.c(b) != 0 for b in self.rows(branches)]
+
+    # float(expr) on each branch, as a list
+    def float_values(self, expr, branches):
+        vals = self.batch_values(expr, branches)
+        if vals is not None: return batch.to_floats(vals, expr.float).tolist()
+        return [float(expr.c(b)) for b in self.rows(branches)]
+
+    # value of an integer expression on each branch, as a list of es_int
+    def int_values(self, expr, branches):
+        vals = None if expr.float else self.batch_values(expr, branches)
+        if vals is not None: return [decode(enc) for enc in vals.tolist()]
+        return [expr.c(b) for b in self.rows(branches)]
+
+    def expression_values(self, expr, branches=None):
+        np = self.get_numpy("batch evaluation")
+        if branches is None:
+            self.focus(expr)
+            self.settle()
+            branches = self.state()
+
+        vals = None
+        if len(branches) > 0 and not isinstance(branches, ColumnState):
+            try: vals = self.batch_values(expr, self.pack_columns(branches, self.expr_regs(expr)))
+            except OverflowError: pass
+        else: vals = self.batch_values(expr, branches)
+
+        if vals is None:
+            cast = float if expr.float else int
+            return np.array([cast(expr.c(b)) for b in self.rows(branches)])
+        if expr.float: return vals
+        return batch.to_ints(vals)
+
+    ################### Controls
+
+    # the mask parent (None for all branches) restricted to where ctrl is true
+    def restrict_mask(self, state, parent, ctrl):
+        if isinstance(state, ColumnState):
+            np = self.get_numpy("numpy backend")
+            if parent is None: sel = np.arange(len(state))
+            else: sel = np.nonzero(np.asarray(parent, dtype=bool))[0]
+
+            mask = np.zeros(len(state), dtype=bool)
+            sub = self.column_subset(state, sel, ctrl)
+            vals = self.batch_values(ctrl, sub)
+            if vals is not None: mask[sel] = vals != 0
+            else: mask[sel] = [ctrl.c(row) != 0 for row in sub.rows()]
+            return mask
+
+        if parent is None: return self.truth_values(ctrl, state)
+        if not isinstance(parent, list): parent = parent.tolist()
+        truth = iter(self.truth_values(ctrl, [b for b, t in zip(state, parent) if t]))
+        return [t and next(truth) for t in parent]
+
+    # boolean array of the branches where the controls are true
+    def control_mask(self, cols):
+        np = self.get_numpy("numpy backend")
+        mask = self.active_mask()
+        if mask is None: return np.ones(len(cols), dtype=bool)
+        return np.asarray(mask, dtype=bool)
+
+    # the rows of cols with the given indices, with the registers expr needs
+    def column_subset(self, cols, sel, expr):
+        if len(sel) == len(cols): return cols
+        return cols.take(sel, self.expr_regs(expr))
+
+    # values of an integer expression on the selected rows as an int64 array
+    # returns None if some value does not fit
+    def column_ints(self, cols, expr, sel):
+        np = self.get_numpy("numpy backend")
+        vals = self.batch_values(expr, self.column_subset(cols, sel, expr))
+        if vals is not None and not expr.float: return batch.to_ints(vals)
+
+        rows = cols.rows()
+        vals = [int(expr.c(rows[i])) for i in sel]
+        if any(abs(v) > batch.max_mag for v in vals): return None
+        return np.array(vals, dtype=np.int64)
+
+    ################### Primitives
+
+    # the *_columns methods return False if the columns can't represent
+    # the result, in which case the caller falls back to branch dicts.
+
+    def alloc_columns(self, cols, reg, val):
+        np = self.get_numpy("numpy backend")
+        cols.regs[reg] = np.full(len(cols), encode(val), dtype=np.int64)
+
+    def alloc_inv_columns(self, cols, reg):
+        mask = self.control_mask(cols)
+        if (cols.regs[reg][mask] != 0).any(): raise ValueError("Failed to clean register.")
+        del cols.regs[reg]
+
+    def oper_columns(self, cols, key, do):
+        np = self.get_numpy("numpy backend")
+        sel = np.nonzero(self.control_mask(cols))[0]
+
+        if isinstance(do, Expression):
+            vals = self.batch_values(do, self.column_subset(cols, sel, do))
+            if vals is not None:
+                cols.regs[key.index()][sel] = vals
+                return True
+
+        rows = cols.rows()
+        try: vals = [encode(do(rows[i])) for i in sel]
+        except OverflowError: return False
+
+        cols.regs[key.index()][sel] = vals
+        return True
+
+    def phase_columns(self, cols, theta):
+        np = self.get_numpy("numpy backend")
+        sel = np.nonzero(self.control_mask(cols))[0]
+
+        thetas = self.float_values(theta, self.column_subset(cols, sel, theta))
+        cols.amp[sel] *= np.exp(1j*np.array(thetas))
+        return True
+
+    def cnot_columns(self, cols, key, idx1, idx2):
+        np = self.get_numpy("numpy backend")
+        sel = np.nonzero(self.control_mask(cols))[0]
+
+        v_idx1 = self.column_ints(cols, idx1, sel)
+        v_idx2 = self.column_ints(cols, idx2, sel)
+        if v_idx1 is None or v_idx2 is None: return False
+        if len(sel) == 0: return True
+
+        if (v_idx1 == v_idx2).any(): raise ValueError("Can't perform CNOT from index to itself.")
+        # bits beyond the column width and negative indices go through es_int
+        for v in [v_idx1, v_idx2]:
+            if v.min() < -1 or v.max() > 61: return False
+
+        col = cols.regs[key.index()]
+        vals = col[sel]
+        col[sel] = vals ^ (((vals >> (v_idx1+1)) & 1) << (v_idx2+1))
+        return True
+
+    def swap_columns(self, cols, key1, key2):
+        sel = self.control_mask(cols)
+        col1, col2 = cols.regs[key1.index()], cols.regs[key2.index()]
+        col1[sel], col2[sel] = col2[sel], col1[sel]
+
+    def had_columns(self, cols, key, bit):
+        np = self.get_numpy("numpy backend")
+        mask = self.control_mask(cols)
+        sel = np.nonzero(mask)[0]
+
+        idx = self.column_ints(cols, bit, sel)
+        if idx is None: return False
+        if len(sel) > 0 and (idx.min() < -1 or idx.max() > 61): return False
+
+        # each controlled branch becomes two consecutive branches
+        counts = np.where(mask, 2, 1)
+        starts = np.cumsum(counts) - counts
+        new = cols.take(np.repeat(np.arange(len(cols)), counts))
+
+        flag = np.left_shift(1, idx+1, dtype=np.int64)
+        vals = cols.regs[key.index()][sel]
+        amp = cols.amp[sel] / math.sqrt(2)
+
+        new.regs[key.index()][starts[sel]] = vals & ~flag
+        new.regs[key.index()][starts[sel]+1] = vals | flag
+        new.amp[starts[sel]] = amp
+        new.amp[starts[sel]+1] = np.where((vals & flag) != 0, -amp, amp)
+
+        self.set_columns(new)
+        self.lazy_prune()
+        return True
+
+    # see walsh in primitive.py
+    def walsh_columns(self, cols, key, bits):
+        np = self.get_numpy("numpy backend")
+        if max(bits) > 61: return False
+
+        k = len(bits)
+        n = 2**k
+        mask = self.control_mask(cols)
+        sel = np.nonzero(mask)[0]
+        if len(sel) == 0: return True
+
+        col = cols.regs[key.index()]
+        rest = col & ~sum(1 << (bit+1) for bit in bits)
+        pattern = np.zeros(len(cols), dtype=np.int64)
+        spread = np.zeros(n, dtype=np.int64)
+        for j in range(k):
+            pattern |= ((col >> (bits[j]+1)) & 1) << (k-1-j)
+            spread |= ((np.arange(n) >> (k-1-j)) & 1) << (bits[j]+1)
+
+        # group controlled rows equal apart from the bits
+        others = [c for reg, c in cols.regs.items() if reg != key.index()]
+        table = np.stack(others + [rest], axis=1)[sel]
+        _, first, inverse = np.unique(table, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        vec = np.zeros((len(first), n), dtype=np.complex128)
+        np.add.at(vec, (inverse, pattern[sel]), cols.amp[sel])
+        for j in range(k):
+            h = 2**j
+            vec = vec.reshape(len(first), n // (2*h), 2, h)
+            vec = np.stack([vec[:,:,0,:] + vec[:,:,1,:], vec[:,:,0,:] - vec[:,:,1,:]], axis=2)
+        vec = vec.reshape(len(first), n) / math.sqrt(n)
+
+        # each group is written out at its first row, uncontrolled rows stay
+        counts = np.where(mask, 0, 1)
+        counts[sel[first]] = n
+        src = np.repeat(np.arange(len(cols)), counts)
+        new = cols.take(src)
+
+        group = np.full(len(cols), -1, dtype=np.int64)
+        group[sel[first]] = np.arange(len(first))
+        starts = np.cumsum(counts) - counts
+        pos = np.nonzero(group[src] >= 0)[0]
+        g = group[src[pos]]
+        t = pos - starts[src[pos]]
+
+        new.regs[key.index()][pos] = rest[src[pos]] | spread[t]
+        new.amp[pos] = vec[g, t]
+
+        self.set_columns(new)
+        self.lazy_prune()
+        return True
+
+    # see qft in primitive.py
+    def qft_columns(self, cols, key, d, inverse):
+        np = self.get_numpy("numpy backend")
+        mask = self.control_mask(cols)
+        sel = np.nonzero(mask)[0]
+
+        dvals = self.float_values(d, self.column_subset(cols, sel, d))
+        for dval in dvals:
+            if dval != int(dval) or int(dval) <= 1:
+                raise ValueError("QFT must be over a positive integer")
+        dvals = np.array([int(dval) for dval in dvals], dtype=np.int64)
+        if len(sel) == 0:
+            self.lazy_prune()
+            return True
+
+        enc = cols.regs[key.index()][sel]
+        vals = (enc >> 1) * (1 - 2*(enc & 1))
+        rem = vals % dvals
+        base = vals - rem
+        if np.abs(base).max() + dvals.max() > batch.max_mag: return False
+
+        others = [c[sel] for reg, c in cols.regs.items() if reg != key.index()]
+        table = np.stack(others + [base, enc & 1, dvals], axis=1)
+        _, first, group = np.unique(table, axis=0, return_index=True, return_inverse=True)
+        group = group.reshape(-1)
+        amp = cols.amp[sel]
+
+        # transform the groups for each d, keeping outputs that aren't negligible
+        gs, ks, amps = [], [], []
+        for dval in np.unique(dvals[first]).tolist():
+            ids = np.nonzero(dvals[first] == dval)[0]
+            local = np.full(len(first), -1, dtype=np.int64)
+            local[ids] = np.arange(len(ids))
+            rows = np.nonzero(dvals == dval)[0]
+
+            vec = np.zeros((len(ids), dval), dtype=np.complex128)
+            np.add.at(vec, (local[group[rows]], rem[rows]), amp[rows])
+            if inverse: vec = np.fft.fft(vec, axis=1) / math.sqrt(dval)
+            else: vec = np.fft.ifft(vec, axis=1) * math.sqrt(dval)
+
+            g, k = np.nonzero(np.abs(vec) > self.thresh)
+            gs.append(ids[g])
+            ks.append(k)
+            amps.append(vec[g, k])
+
+        g, k, amp = np.concatenate(gs), np.concatenate(ks), np.concatenate(amps)
+        order = np.lexsort((k, g))
+        g, k, amp = g[order], k[order], amp[order]
+
+        # each group is written out at its first row, uncontrolled rows stay
+        sizes = np.bincount(g, minlength=len(first))
+        counts = np.where(mask, 0, 1)
+        counts[sel[first]] = sizes
+        starts = np.cumsum(counts) - counts
+        new = cols.take(np.repeat(np.arange(len(cols)), counts))
+
+        pos = starts[sel[first[g]]] + np.arange(len(g)) - (np.cumsum(sizes) - sizes)[g]
+        new.regs[key.index()][pos] = (np.abs(k + base[first[g]]) << 1) | (enc & 1)[first[g]]
+        new.amp[pos] = amp
+
+        self.set_columns(new)
+        self.lazy_prune()
+        return True
+
+    def prune_columns(self, cols):
+        np = self.get_numpy("numpy backend")
+
+        # group rows with equal register values, ordered by first occurrence
+        if len(cols.regs) == 0:
+            first = np.zeros(1, dtype=np.int64)
+            inverse = np.zeros(len(cols), dtype=np.int64)
+        else:
+            table = np.stack(list(cols.regs.values()), axis=1)
+            _, first, inverse = np.unique(table, axis=0, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+
+        amp = np.zeros(len(first), dtype=np.complex128)
+        np.add.at(amp, inverse, cols.amp)
+
+        order = np.argsort(first, kind="stable")
+        first, amp = first[order], amp[order]
+
+        keep = np.abs(amp) > self.thresh
+        first, amp = first[keep], amp[keep]
+
+        keep = self.budget(amp)
+        if keep is not None: first, amp = first[keep], amp[keep]
+
+        new = cols.take(first)
+        new.amp = amp / math.sqrt((np.abs(amp)**2).sum())
+        return new
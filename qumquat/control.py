@@ -43,4 +43,5 @@ class Control:
     def do_control_inv(self, expr):
         if self.queue_action("do_control_inv", expr): return
         self.controls.pop()
+        del self.control_masks[len(self.controls):]
 
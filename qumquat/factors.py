@@ -0,0 +1,144 @@
+from .qvars import *
+from .columns import ColumnState
+
+# factors.py
+#  - set_factorize, merge_factors
+#  - new_factor, focus, focus_regs, focus_factors, fold_factor
+#  - active_regs, arg_regs, factor_keys, get_state, set_state, product
+
+# With factorization, registers known to be independent of the rest of the
+# state are kept in separate factors, each a list of branches (or columns)
+# over only its own registers. The state is the tensor product of the factors.
+# One factor is active: it is what branches holds, and it contains every
+# register that is not in an inactive factor. Primitives call focus with the
+# registers they read or write, which makes the factor holding them active,
+# merging factors only when an operation couples them.
+
+class Factors:
+
+    ################### Factorization
+
+    def set_factorize(self, factorize):
+        if not factorize: self.merge_factors()
+        self.factorize = factorize
+
+    # merge all factors into one and write constant registers into it,
+    # so branches holds the full state
+    def merge_factors(self):
+        if len(self.factors) > 0:
+            self.settle()
+            state = self.get_state()
+            for factor in self.factors:
+                state = self.product(state, factor["state"])
+            self.factors = []
+            self.set_state(state)
+        self.materialize(list(self.consts.keys()))
+
+    # called by reg for a register with a value independent of other
+    # registers: the register is allocated in a new active factor
+    def new_factor(self):
+        if not self.factorize or len(self.controls) > 0 or len(self.queue_stack) > 0: return
+        regs = self.active_regs()
+        if len(regs) == 0: return # the active factor is just a global phase
+
+        self.settle()
+        self.factors.append({"regs": regs, "state": self.get_state()})
+        self.branches = [{"amp": 1+0j}]
+
+    # make the factor holding all registers read by the arguments and by the
+    # controls active, merging the factors they span, and write any of them
+    # that are constant into it
+    def focus(self, *args):
+        if len(self.factors) == 0 and len(self.consts) == 0: return
+        self.focus_regs(self.arg_regs(*args))
+
+    def focus_regs(self, regs):
+        self.focus_factors(regs - set(self.consts.keys()))
+        self.materialize(regs)
+
+    def focus_factors(self, regs):
+        if len(self.factors) == 0: return
+        touched = [factor for factor in self.factors if len(factor["regs"] & regs) > 0]
+        if len(touched) == 0: return
+
+        self.settle()
+        state = self.get_state()
+
+        # all in one inactive factor: swap it with the active one
+        if len(touched) == 1 and regs <= touched[0]["regs"]:
+            active = self.active_regs()
+            self.factors.remove(touched[0])
+            if len(active) > 0:
+                self.factors.append({"regs": active, "state": state})
+                self.set_state(touched[0]["state"])
+            else: # fold the global phase of an empty active factor into the other
+                self.set_state(self.product(state, touched[0]["state"]))
+            return
+
+        for factor in touched:
+            self.factors.remove(factor)
+            state = self.product(state, factor["state"])
+        self.set_state(state)
+
+    # called by alloc_inv: once the active factor has no registers left, its
+    # global phase is folded into another factor, which becomes active
+    def fold_factor(self):
+        if len(self.factors) == 0 or len(self.active_regs()) > 0: return
+        self.settle()
+        factor = self.factors.pop()
+        self.set_state(self.product(self.get_state(), factor["state"]))
+
+    # registers in the active factor
+    def active_regs(self):
+        regs = set(reg for reg in self.key_dict.values() if reg is not None)
+        regs -= set(self.consts.keys())
+        for factor in self.factors: regs -= factor["regs"]
+        return regs
+
+    # registers read by the arguments and by the controls
+    def arg_regs(self, *args):
+        keys = set()
+        for arg in list(args) + self.controls: keys |= self.factor_keys(arg)
+        return set(Key(self, val=k).index() for k in keys)
+
+    # keys read by a register, expression, or a list or dict of them
+    def factor_keys(self, arg):
+        if isinstance(arg, Key): return set([arg.key])
+        if isinstance(arg, Expression): return set(arg.keys)
+
+        keys = set()
+        if isinstance(arg, dict): arg = arg.values()
+        if isinstance(arg, (list, tuple, type({}.values()))):
+            for x in arg: keys |= self.factor_keys(x)
+        return keys
+
+    # the active factor as it is stored now, without converting it
+    def get_state(self):
+        return self._branches if self._columns is None else self._columns
+
+    def set_state(self, state):
+        if isinstance(state, ColumnState):
+            self._branches = None
+            self.set_columns(state)
+        else: self.branches = state
+
+    # tensor product of two factors
+    def product(self, state1, state2):
+        if isinstance(state1, ColumnState) and isinstance(state2, ColumnState):
+            np = self.get_numpy("numpy backend")
+            n1, n2 = len(state1), len(state2)
+            regs = {reg:np.repeat(col, n2) for reg, col in state1.regs.items()}
+            regs.update({reg:np.tile(col, n1) for reg, col in state2.regs.items()})
+            return ColumnState(regs, np.repeat(state1.amp, n2) * np.tile(state2.amp, n1))
+
+        if isinstance(state1, ColumnState): state1 = self.unpack_columns(state1)
+        if isinstance(state2, ColumnState): state2 = self.unpack_columns(state2)
+
+        out = []
+        for b1 in state1:
+            for b2 in state2:
+                branch = dict(b1)
+                branch.update(b2)
+                branch["amp"] = b1["amp"] * b2["amp"]
+                out.append(branch)
+        return out
@@ -30,6 +30,7 @@ class Garbage:
                     return s.compute(b)
 
                 s.c = lambda b: run_without_garbage(b)
+                s.v = None # running f can't be batched
                 s.float = True # can't be determined now, assume the worst.
                 s.qq = self
 
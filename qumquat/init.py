@@ -1,5 +1,5 @@
 from .qvars import *
-import math, copy
+import math
 
 class Init:
 
@@ -14,6 +14,9 @@ class Init:
         if isinstance(val, Key): val = Expression(val)
         if isinstance(val, int) or isinstance(val, es_int): val = Expression(val, self)
 
+        if isinstance(val, Expression) and self.scalar_init(key, val, False): return
+        self.focus(key, val)
+
         if isinstance(val, Expression):
             self.init_expression(key,val)
         elif isinstance(val, list):
@@ -33,6 +36,9 @@ class Init:
         if isinstance(val, Key): val = Expression(val)
         if isinstance(val, int) or isinstance(val, es_int): val = Expression(val, self)
 
+        if isinstance(val, Expression) and self.scalar_init(key, val, True): return
+        self.focus(key, val)
+
         if isinstance(val, Expression):
             self.init_expression(key,val,invert=True)
         elif isinstance(val, list):
@@ -50,82 +56,117 @@ class Init:
 
         # strategy:
         # for each value of expr, create a list [0,expr,other,initial,vals]
-        # then the unitary simply shifts forward by one
-
-        H = set([b[key.index()] for b in self.controlled_branches()]) - set([es_int(0)])
-
-        for b in self.controlled_branches():
-            v = es_int(expr.c(b))
-            if v != es_int(0): # if already zero do nothing
-
-                thisH = [es_int(0),v] + sorted(list(H - set([v])))
-
-                idx = thisH.index(b[key.index()])
-                if not invert:
-                    b[key.index()] = thisH[(idx + 1) % len(thisH)]
-                else:
-                    b[key.index()] = thisH[(len(thisH) + idx - 1) % len(thisH)]
+        # then the unitary simply shifts forward by one.
+        # The other values are found by position in the sorted list of all values.
+
+        idx = key.index()
+        zero = es_int(0)
+        self.settle() # H must only contain values that are present
+        branches = self.controlled_branches()
+
+        H = sorted(set([b[idx] for b in branches]) - set([zero]))
+        pos = {h:i for i, h in enumerate(H)}
+
+        # the value at position i in H, skipping over v, or None past either end
+        def at(i, step, v):
+            if 0 <= i < len(H) and H[i] == v: i += step
+            if 0 <= i < len(H): return H[i]
+            return None
+
+        for b, v in zip(branches, self.int_values(expr, branches)):
+            v = es_int(v)
+            if v == zero: continue # if already zero do nothing
+
+            val = b[idx]
+            if not invert:
+                if val == zero: new = v
+                elif val == v: new = at(0, 1, v)
+                else: new = at(pos[val]+1, 1, v)
+                if new is None: new = zero
+            else:
+                if val == zero: new = at(len(H)-1, -1, v)
+                elif val == v: new = zero
+                else: new = at(pos[val]-1, -1, v)
+                if new is None: new = v
+            b[idx] = new
 
 
     ############################ List
 
     def init_list(self,key,ls, invert=False):
         # check list for validity, cast to es_int
+        seen = set()
         for i in range(len(ls)):
             if not (isinstance(ls[i], int) or isinstance(ls[i], es_int)):
                 raise TypeError("Superpositions only support integer literals.")
-            if ls.index(ls[i]) != i:
-                raise ValueError("Superpositions can't contain repeated values.")
             if isinstance(ls[i], int):
                 ls[i] = es_int(ls[i])
+            if ls[i] in seen:
+                raise ValueError("Superpositions can't contain repeated values.")
+            seen.add(ls[i])
 
         p = 1/math.sqrt(len(ls))
-        H = (set([b[key.index()] for b in self.controlled_branches()]) | set(ls)) - set([es_int(0)])
-        H = [es_int(0)] + list(H)
-
-        U = [{h:complex(p if (h in ls) else 0) for h in H}] # first column of U
-
-        # complete the rest of the matrix via graham schmidt
-        for i in H[1:]+H[:1]: # this way its closer to the identity
-            newcol = {h:complex(1 if (h == i) else 0) for h in H}
-            for col in U:
-                inner = sum([col[h].conjugate()*newcol[h] for h in H])
-                for h in H: newcol[h] -= col[h]*inner
-
-            # normalize
-            norm = math.sqrt(sum([abs(newcol[h])**2 for h in H]))
-            if norm < self.thresh: continue
-            for h in H: newcol[h] /= norm
-            U.append(newcol)
-
-        if len(U) != len(H): raise ValueError("Error in matrix completion. (This can happen when amplitudes get too small.)")
-
-        if invert:
-            newU = []
-            for i in H:
-                newU.append({h:(U[H.index(h)][i].conjugate()) for h in H})
-
-            U = newU
+        reflection = self.householder({v:p for v in ls})
+        self.reflect(key, lambda b: reflection, invert)
+
+    # Prepares states without building a unitary. For a normalized dict vec of
+    # value -> amplitude, with phase making vec[0] / phase real and non-negative,
+    #   U = (I - w w^dag / (1 + |vec[0]|)) D,   w = |0> + vec / phase,
+    # where D multiplies the amplitude of 0 by -phase. The first factor is a
+    # Householder reflection, and U|0> = vec. U is the identity on values other
+    # than 0 and those in vec.
+    def householder(self, vec):
+        zero = es_int(0)
+        v0 = complex(vec.get(zero, 0))
+        phase = v0/abs(v0) if abs(v0) > 0 else 1
+        w = {h:complex(a)/phase for h, a in vec.items()}
+        w[zero] = w.get(zero, 0) + 1
+        return w, phase, 1 + abs(v0)
+
+    # Apply U, or U^dag if invert, to key on the controlled branches. Branches
+    # equal apart from key form a vector, and U is given by reflection(branch)
+    # for the group's first branch. Groups are written out where their first branch was.
+    def reflect(self, key, reflection, invert):
+        idx = key.index()
+        zero = es_int(0)
 
         newbranches = []
+        groups = {} # signature -> (branch, reflection, dict of value -> amplitude)
+        for branch, good in zip(self.branch_list(), self.control_list()):
+            if not good:
+                newbranches.append(branch)
+                continue
 
-        goodbranch = lambda b: all([ctrl.c(b) != 0 for ctrl in self.controls])
-        for b in self.branches:
-            if not goodbranch(b):
-                newbranches.append(b)
+            sig = tuple(sorted((r, v) for r, v in branch.items() if r not in ["amp", idx]))
+            if sig not in groups:
+                groups[sig] = (branch, reflection(branch), {})
+                newbranches.append(sig)
+            amps = groups[sig][2]
+            amps[branch[idx]] = amps.get(branch[idx], 0) + branch["amp"]
+
+        out = []
+        for item in newbranches:
+            if isinstance(item, dict):
+                out.append(item)
                 continue
 
-            row = U[H.index(b[key.index()])]
-            for h in H:
-                if abs(row[h]) != 0:
-                    newbranch = copy.copy(b)
-                    newbranch[key.index()] = h
-                    newbranch["amp"] *= row[h]
-                    newbranches.append(newbranch)
+            branch, (w, phase, denom), amps = groups[item]
+            if not invert and zero in amps: amps[zero] *= -phase
+
+            inner = sum(wh.conjugate()*amps[h] for h, wh in w.items() if h in amps) / denom
+            for h, wh in w.items(): amps[h] = amps.get(h, 0) - wh*inner
 
-        self.branches = newbranches
-        self.prune()
+            if invert: amps[zero] *= -phase.conjugate()
 
+            for h, amp in amps.items():
+                if amp == 0: continue
+                newbranch = dict(branch)
+                newbranch[idx] = h
+                newbranch["amp"] = amp
+                out.append(newbranch)
+
+        self.branches = out
+        self.lazy_prune()
 
 
     ############################ Dictionary
@@ -142,100 +183,23 @@ class Init:
 
         if key.key in keys: raise SyntaxError("Can't initialize register based on itself.")
 
-        keys = [Key(self,val=k) for k in keys]
-
-
-        ############## sort branches into groups with equal value
-
-        def branchesEqual(b1, b2):
-            for k in keys:
-                if self.branches[b1][k.index()] != self.branches[b2][k.index()]:
-                    return False
-            return True
-
-        branch_type_counter = 0
-        branchtypes = {}
-
-        goodbranch = lambda b: all([ctrl.c(b) != 0 for ctrl in self.controls])
-        for i in range(len(self.branches)):
-            b = self.branches[i]
-            if not goodbranch(b): continue
-
-            found = False
-            for j in branchtypes:
-                if branchesEqual(branchtypes[j][0], i):
-                    found = True
-                    branchtypes[j].append(i)
-                    break
-
-            if not found:
-                branchtypes[branch_type_counter] = [i]
-                branch_type_counter += 1
-                continue
-
-
-        ############ determine unitary for each group
-
-        H = set([b[key.index()] for b in self.controlled_branches()])
-        H = (H | set(dic.keys())) - set([es_int(0)])
-        H = [es_int(0)] + list(H)
-
-        unitaries = []
-
-        for j in range(branch_type_counter):
-            norm = 0
-            for k in dic.keys(): norm += abs( dic[k].c(self.branches[branchtypes[j][0]]) )**2
-            norm = math.sqrt(norm)
-
-            U = [{h:(dic[h].c(self.branches[branchtypes[j][0]])/norm\
-                    if h in dic.keys() else complex(0)) for h in H}]
-
-            # complete the rest of the matrix via graham schmidt
-            for i in H[1:]+H[:1]: # this way its closer to the identity
-                newcol = {h:complex(1 if (h == i) else 0) for h in H}
-                for col in U:
-                    inner = sum([col[h].conjugate()*newcol[h] for h in H])
-                    for h in H: newcol[h] -= col[h]*inner
-
-                # normalize
-                norm = math.sqrt(sum([abs(newcol[h])**2 for h in H]))
-                if norm < self.thresh: continue
-                for h in H: newcol[h] /= norm
-                U.append(newcol)
-
-
-            if len(U) != len(H): raise ValueError("Error in matrix completion. (This can happen when amplitudes get too small.)")
-
-            if invert:
-                newU = []
-                for i in H:
-                    newU.append({h:(U[H.index(h)][i].conjugate()) for h in H})
-
-                unitaries.append(newU)
-            else:
-                unitaries.append(U)
-
-        ########### apply unitary
-
-        newbranches = []
-        for i in range(len(self.branches)):
-            b = self.branches[i]
-            if not goodbranch(b):
-                newbranches.append(b)
-                continue
+        # the amplitudes only depend on the registers in keys, and groups with
+        # the same rounded amplitudes share a reflection
+        regs = [Key(self,val=k).index() for k in keys]
+        by_regs = {} # values of regs -> reflection
+        by_amps = {} # rounded amplitude vector -> reflection
 
-            for j in range(branch_type_counter):
-                if i in branchtypes[j]: break
+        def reflection(b):
+            vals = tuple(b[r] for r in regs)
+            if vals in by_regs: return by_regs[vals]
 
-            U = unitaries[j]
-            row = U[H.index(b[key.index()])]
-            for h in H:
-                if abs(row[h]) != 0:
-                    newbranch = copy.copy(b)
-                    newbranch[key.index()] = h
-                    newbranch["amp"] *= row[h]
-                    newbranches.append(newbranch)
+            vec = {h:float(dic[h].c(b)) for h in dic.keys()}
+            norm = math.sqrt(sum(a**2 for a in vec.values()))
+            vec = {h:a/norm for h, a in vec.items()}
 
-        self.branches = newbranches
-        self.prune()
+            rounded = tuple((h, round(a, 12)) for h, a in vec.items())
+            if rounded not in by_amps: by_amps[rounded] = self.householder(vec)
+            by_regs[vals] = by_amps[rounded]
+            return by_regs[vals]
 
+        self.reflect(key, reflection, invert)
@@ -1,10 +1,12 @@
 from .qvars import *
-import cmath
+import cmath, math, heapq
 
 # keys.py:
 #  - clear
-#  - prune
-#  - alloc
+#  - set_lazy, lazy_prune, settle, prune
+#  - set_budget, budget
+#  - alloc, release_key
+#  - materialize, scalar, scalar_init
 #  - reg
 #  - clean
 #  - expr
@@ -20,40 +22,107 @@ class Keys:
             raise SyntaxError("Cannot clear inside quantum control flow.")
 
         self.key_dict = {}
+        self.free_regs = []
+        self.factors = []
+        self.consts = {}
         self.branches = [{"amp": 1+0j}]
+        self.unpruned = False
+        self.discarded_norm = 0
+
+    # hashable canonical signature of a branch: its register values sorted by register
+    def branch_sig(self, branch):
+        return tuple(sorted((key, val) for key, val in branch.items() if key != "amp"))
+
+    # In lazy mode primitives don't prune, unless there are more than
+    # lazy_max_branches branches. Anything that reads the distribution or
+    # depends on which values are present calls settle first.
+    def set_lazy(self, lazy, max_branches=2**16):
+        self.lazy = lazy
+        self.lazy_max_branches = max_branches
+        if not lazy: self.settle()
+
+    # called by primitives after creating branches
+    def lazy_prune(self):
+        if not self.lazy:
+            self.prune()
+            return
+
+        self.unpruned = True
+        state = self._branches if self._columns is None else self._columns
+        if self.lazy_max_branches is not None and len(state) > self.lazy_max_branches:
+            self.prune()
+
+    # prune if lazy_prune didn't
+    def settle(self):
+        if self.unpruned: self.prune()
+
+    # Approximate simulation: prune keeps only the max_branches branches with
+    # the largest amplitudes. discarded_norm adds up the norm of the dropped
+    # amplitudes, which bounds the distance from the exact state. Branches are
+    # not dropped if that would make discarded_norm exceed max_discarded_norm.
+    def set_budget(self, max_branches=None, max_discarded_norm=None):
+        if max_branches is not None and max_branches < 1:
+            raise ValueError("Branch budget must keep at least one branch.")
+        if max_discarded_norm is not None and max_discarded_norm < 0:
+            raise ValueError("Discarded norm budget can't be negative.")
+        self.max_branches = max_branches
+        self.max_discarded_norm = max_discarded_norm
+
+    # indices of the amplitudes kept by the branch budget, in order,
+    # or None to keep all of them
+    def budget(self, amps):
+        if self.max_branches is None or len(amps) <= self.max_branches: return None
+        k = self.max_branches
+
+        if isinstance(amps, list):
+            keep = sorted(heapq.nlargest(k, range(len(amps)), key=lambda i: abs(amps[i])))
+            total = sum(abs(a)**2 for a in amps)
+            kept = sum(abs(amps[i])**2 for i in keep)
+        else:
+            np = self.get_numpy("numpy backend")
+            keep = np.sort(np.argpartition(-np.abs(amps), k-1)[:k])
+            total = (np.abs(amps)**2).sum()
+            kept = (np.abs(amps[keep])**2).sum()
+        if total == 0: return None
+
+        norm = self.discarded_norm + math.sqrt(max(total - kept, 0) / total)
+        if self.max_discarded_norm is not None and norm > self.max_discarded_norm: return None
+        self.discarded_norm = norm
+        return keep
 
     # get rid of branches with tiny amplitude
     # merge branches with same values
     def prune(self):
-        norm = 0
+        self.unpruned = False
+        cols = self.columns()
+        if cols is not None:
+            self.set_columns(self.prune_columns(cols))
+            return
 
-        mergedbranches = []
-        for branch in self.branches:
-            found = False
-            for comp_branch in mergedbranches:
-                same = True
-                for key in branch.keys():
-                    if key == "amp": continue
-                    if branch[key] != comp_branch[key]:
-                        same = False
-                        break
-                if same:
-                    found = True
-                    comp_branch["amp"] += branch["amp"]
+        norm = 0
 
-            if not found: mergedbranches.append(branch)
+        # first branch with each signature absorbs the amplitudes of the others
+        merged = {}
+        for branch in self.branch_list():
+            sig = self.branch_sig(branch)
+            if sig in merged: merged[sig]["amp"] += branch["amp"]
+            else: merged[sig] = branch
+        mergedbranches = list(merged.values())
 
         newbranches = []
         for branch in mergedbranches:
             if abs(branch["amp"]) > self.thresh:
                 newbranches.append(branch)
 
+        keep = self.budget([branch["amp"] for branch in newbranches])
+        if keep is not None: newbranches = [newbranches[i] for i in keep]
+
         for branch in newbranches:
             norm += abs(branch["amp"])**2
         norm = cmath.sqrt(norm)
 
         self.branches = newbranches
-        for branch in self.branches:
+        for branch in self.branch_list():
             branch["amp"] /= norm
 
 
@@ -66,11 +135,15 @@ class Keys:
         if key.allocated():
             raise SyntaxError("Attempted to allocate already allocated key.")
 
-        reg = self.reg_count
+        # reuse the slot of a deallocated register if there is one
+        if len(self.free_regs) > 0: reg = self.free_regs.pop()
+        else:
+            reg = self.reg_count
+            self.reg_count += 1
         self.key_dict[key.key] = reg
-        self.reg_count += 1
 
-        for branch in self.branches: branch[reg] = es_int(0)
+        # zero on every branch, so it starts out constant
+        self.consts[reg] = es_int(0)
 
 
     def alloc_inv(self, key):
@@ -84,12 +157,26 @@ class Keys:
             target = key.partner()
             proxy = key
 
-        for branch in self.controlled_branches():
-            if branch[target.index()] != 0: raise ValueError("Failed to clean register.")
-
         # remove the register from the branches and key_dict
-        for branch in self.branches: branch.pop(target.index())
+        reg = target.index()
+        if reg in self.consts and (self.consts[reg] == 0 or len(self.controls) == 0):
+            if self.consts[reg] != 0: raise ValueError("Failed to clean register.")
+            del self.consts[reg]
+        else:
+            self.focus(target)
+            self.settle()
+            cols = self.columns()
+            if cols is not None:
+                self.alloc_inv_columns(cols, reg)
+            else:
+                for branch in self.controlled_branches():
+                    if branch[reg] != 0: raise ValueError("Failed to clean register.")
+
+                for branch in self.branch_list(): branch.pop(reg)
         self.key_dict[target.key] = None
+        if target.key not in self.live_keys: del self.key_dict[target.key]
+        self.free_regs.append(reg)
+        self.fold_factor()
 
         pile = key.pile()
 
@@ -107,6 +194,65 @@ class Keys:
                     del pile[i]
                     break
 
+    ############################ Constant registers
+
+    # Registers with the same value on every branch are kept in consts,
+    # register -> es_int, instead of in the branches. focus writes them into
+    # the branches before an operation that could make them vary.
+
+    # Classical fast path: if the arguments and controls only read constant
+    # registers, or the state has a single branch, returns the branches to
+    # operate on: [] if the controls are false, otherwise consts or the single
+    # branch. Returns None if the operation is not classical. With amp, the
+    # branch must have an amplitude, so consts are not used.
+    def scalar(self, *args, amp=False):
+        regs = self.arg_regs(*args)
+        if not amp and all(reg in self.consts for reg in regs):
+            branch = self.consts
+        else:
+            if len(self.get_state()) != 1: return None
+            self.focus_regs(regs)
+            if len(self.get_state()) != 1: return None # merged with other factors
+            branch = self.branch_list()[0]
+
+        for ctrl in self.controls:
+            if not ctrl.c(branch): return []
+        return [branch]
+
+    # write constant registers into every branch of the active factor
+    def materialize(self, regs):
+        for reg in [reg for reg in regs if reg in self.consts]:
+            val = self.consts.pop(reg)
+            cols = self.columns()
+            if cols is not None:
+                try:
+                    self.alloc_columns(cols, reg, val)
+                    continue
+                except OverflowError: pass
+            for branch in self.branch_list(): branch[reg] = val
+
+    # init_expression on the classical fast path, returns False if not classical.
+    # With one value in the register, the shift of init_expression maps
+    # 0 -> v -> 0 and anything else to 0, or to v when inverted.
+    def scalar_init(self, key, expr, invert):
+        if expr.float or key.key in expr.keys: return False
+        branches = self.scalar(key, expr)
+        if branches is None: return False
+
+        idx = key.index()
+        for b in branches:
+            v = es_int(expr.c(b))
+            if v == 0: continue
+            if not invert: b[idx] = v if b[idx] == 0 else es_int(0)
+            else: b[idx] = es_int(0) if b[idx] == v else v
+        return True
+
+    # Called when the Key object that created a key is garbage collected.
+    # An unallocated key can then never be used again, so it is forgotten.
+    def release_key(self, key):
+        self.live_keys.discard(key)
+        if key in self.key_dict and self.key_dict[key] is None: del self.key_dict[key]
+
     ########################### User functions for making and deleting registers
 
     def reg(self, *vals):
@@ -119,6 +265,7 @@ class Keys:
             if len(self.pile_stack_py) > 0:
                 self.pile_stack_py[-1].append(key)
 
+            if len(self.factor_keys(val)) == 0: self.new_factor()
             self.alloc(key)
             key.init(val)
 
@@ -11,17 +11,62 @@ from .garbage import Garbage
 from .primitive import Primitive
 from .utils import Utils
 from .snapshots import Snapshots
+from .columns import Columns
+from .factors import Factors
 
+# - branches, branch_list
 # - queue_action, queue_stack
 # - call (inversion, controls)
 # - assert_mutable
-# - controlled_branches
+# - controlled_branches, active_mask, control_list
 # - key_count, reg_count, key_dict
 # - pile_stack, garbage_piles, garbage_stack
 # - push_mode, pop_mode, mode_stack
 
-class Qumquat(Keys, Init, Measure, Control, Primitive, Utils, Snapshots, Garbage):
-    branches = [{"amp": 1+0j}]
+class Qumquat(Keys, Init, Measure, Control, Primitive, Utils, Snapshots, Garbage, Columns, Factors):
+
+    # the state is either a list of branches or, with the numpy backend,
+    # a ColumnState (see columns.py). Reading branches always gives the
+    # list, unpacking a copy of the columns if necessary, so that reading
+    # it doesn't take the state out of the columns. Constant registers
+    # (see keys.py) are added to copies of the rows. In both cases
+    # changing the rows read from branches doesn't change the state, so
+    # code that modifies the state in place uses branch_list.
+    _branches = [{"amp": 1+0j}]
+    _columns = None
+
+    @property
+    def branches(self):
+        if self._columns is not None: branches = self.unpack_columns(self._columns)
+        else: branches = self._branches
+        if len(self.consts) == 0: return branches
+
+        rows = []
+        for branch in branches:
+            row = dict(branch)
+            row.update(self.consts)
+            rows.append(row)
+        return rows
+
+    # the list of branches that primitives modify in place, replacing
+    # the columns with it if necessary
+    def branch_list(self):
+        if self._columns is not None:
+            self._branches = self.unpack_columns(self._columns)
+            self._columns = None
+        return self._branches
+
+    @branches.setter
+    def branches(self, branches):
+        self._branches = branches
+        self._columns = None
+        self.branch_version += 1
+
+    factorize = False # keep independent registers in separate factors, see factors.py
+    factors = [] # inactive factors: dicts with "regs" and "state"
+    consts = {} # registers with the same value on every branch, see keys.py
+
+    branch_version = 0 # changes whenever branches are created, removed or reordered
 
     queue_stack = [] # list of list of action tuples
 
@@ -41,6 +86,9 @@ class Qumquat(Keys, Init, Measure, Control, Primitive, Utils, Snapshots, Garbage
 
     controls = [] # list of expressions
 
+    # for each depth of controls: (control, branch_version, mask) or None
+    control_masks = []
+
     # any keys affecting controls cannot be modified
     def assert_mutable(self, key):
         if not isinstance(key, Key):
@@ -49,19 +97,57 @@ class Qumquat(Keys, Init, Measure, Control, Primitive, Utils, Snapshots, Garbage
             if key.key in ctrl.keys:
                 raise SyntaxError("Cannot modify value of controlling register.")
 
+    # Booleans marking the branches where all controls are true, as a numpy
+    # array or a list, or None without controls. The mask for each depth of
+    # nested controls is the mask of the parent restricted to one more control.
+    # Masks are kept until branches change or the control block is left.
+    def active_mask(self):
+        del self.control_masks[len(self.controls):]
+        while len(self.control_masks) < len(self.controls): self.control_masks.append(None)
+
+        # whichever representation the state is in now, without converting it
+        state = self._branches if self._columns is None else self._columns
+        mask = None
+        for depth in range(len(self.controls)):
+            ctrl = self.controls[depth]
+            cached = self.control_masks[depth]
+            if cached is not None and cached[0] is ctrl and cached[1] == self.branch_version:
+                mask = cached[2]
+                continue
+
+            mask = self.restrict_mask(state, mask, ctrl)
+            self.control_masks[depth] = (ctrl, self.branch_version, mask)
+        return mask
+
+    # list of booleans marking the branches where controls are true
+    def control_list(self):
+        mask = self.active_mask()
+        if mask is None: return [True]*len(self.branch_list())
+        if not isinstance(mask, list): mask = mask.tolist()
+        return mask
+
     # only operate on branches where controls are true
     def controlled_branches(self):
-        goodbranch = lambda b: all([ctrl.c(b) != 0 for ctrl in self.controls])
-        return [b for b in self.branches if goodbranch(b)]
+        if len(self.controls) == 0: return self.branch_list()
+        return [b for b, t in zip(self.branch_list(), self.control_list()) if t]
 
     key_count = 0
     reg_count = 0
     key_dict = {} # dictionary of registers for each key
+    free_regs = [] # registers of deallocated keys, to be reused
+    live_keys = set() # keys whose Key object still exists
 
     pile_stack_py = [] # stack during python run time
     pile_stack_qq = [] # stack during qq execution
 
     thresh = 1e-10 # threshold for deleting tiny amplitudes.
+    lazy = False # defer pruning until the state is read, see set_lazy
+    lazy_max_branches = 2**16 # prune anyway beyond this many branches
+    unpruned = False # whether pruning was deferred
+    max_branches = None # branch budget, see set_budget
+    max_discarded_norm = None
+    discarded_norm = 0 # bound on the error from the branch budget
+    batch_size = 64 # evaluate expressions with numpy on at least this many branches
     print_prob_digs = 5 # print probabilities/amplitudes to this precision
     print_expr_digs  = 5 # print values of expressions to this precision
 
@@ -1,64 +1,88 @@
 from .qvars import *
-import cmath, math
-from random import random
+import cmath, math, heapq, bisect, itertools
+from random import random, Random
 
 # measure.py
 #  - dist
-#  - measure
+#  - expect, variance
+#  - measure, sample
 #  - postselect
 #  - print, print_amp
 
 class Measure:
     ######################################## Measurement and printing
 
-    def dist(self, *exprs, branches=False):
-        def cast(ex):
-            if isinstance(ex, str):
-                class Dummy():
-                    def c(s, b): return ex
-                return Dummy()
-            return Expression(ex, self)
+    # the rounded values of exprs on each branch, and the amplitudes
+    def branch_values(self, exprs):
+        self.focus(*exprs)
+        self.settle()
+        state = self.state()
+        amps = self.amplitudes(state)
 
-        def dofloat(ex):
+        columns = []
+        for ex in exprs:
             if isinstance(ex, str):
-                return ex
-            else: return round(float(ex), self.print_expr_digs)
-
-        exprs = [cast(expr) for expr in exprs]
-
-        values = []
-        configs = []
-        probs = []
-
-        for i in range(len(self.branches)):
-            branch = self.branches[i]
-
-            if len(exprs) == 1:
-                val = dofloat(exprs[0].c(branch))
-            else:
-                val = tuple([dofloat(expr.c(branch)) for expr in exprs])
-
-            if val not in values:
-                values.append(val)
-                configs.append([i])
-                probs.append(abs(branch["amp"])**2)
-            else:
-                idx = values.index(val)
-                configs[idx].append(i)
-                probs[idx] += abs(branch["amp"])**2
-
-        idxs = list(range(len(probs)))
-        idxs.sort(key=lambda i:values[i])
-
-        values = [values[i] for i in idxs]
-        probs = [probs[i] for i in idxs]
-        configs = [configs[i] for i in idxs]
-
+                columns.append([ex]*len(amps))
+                continue
+            ex = Expression(ex, self)
+            columns.append([round(v, self.print_expr_digs) for v in self.float_values(ex, state)])
+
+        if len(exprs) == 1: vals = columns[0]
+        else: vals = list(zip(*columns)) if len(exprs) > 0 else [()]*len(amps)
+        return vals, amps
+
+    # top_k keeps only the k most likely outcomes, min_prob only those
+    # with at least that probability. Outcomes are sorted by value.
+    def dist(self, *exprs, branches=False, top_k=None, min_prob=None):
+        vals, amps = self.branch_values(exprs)
+
+        # one pass over the branches: value -> [probability, branch indices],
+        # with the indices only collected if they are returned
+        outcomes = {}
+        for i in range(len(vals)):
+            if vals[i] in outcomes:
+                outcome = outcomes[vals[i]]
+                outcome[0] += abs(amps[i])**2
+                if branches: outcome[1].append(i)
+            else: outcomes[vals[i]] = [abs(amps[i])**2, [i] if branches else None]
+
+        values = list(outcomes.keys())
+        if min_prob is not None:
+            values = [val for val in values if outcomes[val][0] >= min_prob]
+        if top_k is not None:
+            values = heapq.nlargest(top_k, values, key=lambda val: outcomes[val][0])
+        values.sort()
+
+        probs = [outcomes[val][0] for val in values]
         if branches:
-            return values, probs, configs
+            return values, probs, [outcomes[val][1] for val in values]
         else:
             return values, probs
 
+    # mean and variance of each expression, evaluated once on all branches
+    def moments(self, exprs):
+        self.focus(*exprs)
+        self.settle()
+        state = self.state()
+        probs = [abs(a)**2 for a in self.amplitudes(state)]
+
+        out = []
+        for ex in exprs:
+            vals = self.float_values(Expression(ex, self), state)
+            mean = sum(p*v for p, v in zip(probs, vals))
+            var = sum(p*(v - mean)**2 for p, v in zip(probs, vals))
+            out.append((mean, var))
+        return out
+
+    # expected value of an expression, or a list of them for a list of expressions
+    def expect(self, expr):
+        if isinstance(expr, (list, tuple)): return [m[0] for m in self.moments(expr)]
+        return self.moments([expr])[0][0]
+
+    def variance(self, expr):
+        if isinstance(expr, (list, tuple)): return [m[1] for m in self.moments(expr)]
+        return self.moments([expr])[0][1]
+
     def measure(self, *var):
         if len(self.mode_stack) > 0:
             raise SyntaxError("Can only measure at top-level.")
@@ -69,22 +93,38 @@ class Measure:
         values, probs, configs = self.dist(*var, branches=True)
 
         # pick outcome
-        r = random()
-        cumul = 0
-        pick = -1
-        for i in range(len(probs)):
-            if cumul + probs[i] > r:
-                pick = i
-                break
-            else: cumul += probs[i]
+        cumul = list(itertools.accumulate(probs))
+        pick = min(bisect.bisect_right(cumul, random()*cumul[-1]), len(probs)-1)
 
         # collapse superposition
-        self.branches = [self.branches[i] for i in configs[pick]]
-        for branch in self.branches:
-            branch["amp"] /= math.sqrt(probs[pick])
+        self.select_branches(configs[pick], math.sqrt(probs[pick]))
 
         return values[pick]
 
+    # measure many times without collapsing the state
+    # returns a dictionary: outcome -> number of shots with that outcome
+    def sample(self, *exprs, shots=1, seed=None):
+        if len(self.mode_stack) > 0:
+            raise SyntaxError("Can only sample at top-level.")
+
+        values, probs = self.dist(*exprs)
+
+        # binary search for each shot in the cumulative distribution
+        if batch.np is not None:
+            np = batch.np
+            cumul = np.cumsum(probs)
+            r = np.random.default_rng(seed).random(shots) * cumul[-1]
+            picks = np.minimum(np.searchsorted(cumul, r, side="right"), len(probs)-1)
+            counts = np.bincount(picks, minlength=len(probs)).tolist()
+        else:
+            cumul = list(itertools.accumulate(probs))
+            rng = Random(seed)
+            counts = [0]*len(probs)
+            for i in range(shots):
+                counts[min(bisect.bisect_right(cumul, rng.random()*cumul[-1]), len(probs)-1)] += 1
+
+        return {values[i]:counts[i] for i in range(len(values)) if counts[i] > 0}
+
     def postselect(self, expr):
         if len(self.mode_stack) > 0:
             raise SyntaxError("Can only measure at top-level.")
@@ -93,26 +133,28 @@ class Measure:
 
         expr = Expression(expr, self)
 
-        newbranches = []
-        prob = 0
-        for branch in self.branches:
-            if expr.c(branch) != 0:
-                newbranches.append(branch)
-                prob += abs(branch["amp"])**2
+        self.focus(expr)
+        self.settle()
+        state = self.state()
+        truth = self.truth_values(expr, state)
+        amps = self.amplitudes(state)
+
+        newbranches = [i for i in range(len(truth)) if truth[i]]
+        prob = sum(abs(amps[i])**2 for i in newbranches)
 
         if len(newbranches) == 0:
             raise ValueError("Postselection failed!")
-        self.branches = newbranches
-
-        for branch in self.branches:
-            branch["amp"] /= math.sqrt(prob)
+        self.select_branches(newbranches, math.sqrt(prob))
 
         return float(prob)
 
-    def print(self, *exprs):
-        if self.queue_action('print', *exprs): return
+    def print(self, *exprs, top_k=None, min_prob=None):
+        self.do_print(exprs, top_k, min_prob)
+
+    def do_print(self, exprs, top_k, min_prob):
+        if self.queue_action('do_print', exprs, top_k, min_prob): return
 
-        values, probs, configs = self.dist(*exprs, branches=True)
+        values, probs = self.dist(*exprs, top_k=top_k, min_prob=min_prob)
         s = []
 
         # print distribution
@@ -123,46 +165,20 @@ class Measure:
             s.append(st + " w.p. " + str(round(probs[i],self.print_prob_digs)))
         print("\n".join(s))
 
-    def print_inv(self, *exprs):
-        if self.queue_action('print_inv', *exprs): return
-        self.print(*exprs)
+    def do_print_inv(self, exprs, top_k, min_prob):
+        if self.queue_action('do_print_inv', exprs, top_k, min_prob): return
+        self.do_print(exprs, top_k, min_prob)
 
     def print_amp(self, *exprs):
         if self.queue_action('print_amp', *exprs): return
 
-        def cast(ex):
-            if isinstance(ex, str):
-                class Dummy():
-                    def c(s, b): return ex
-                return Dummy()
-            return Expression(ex, self)
-        exprs = [cast(expr) for expr in exprs]
-
-        values = []
-        amplitudes = {}
+        vals, amps = self.branch_values(exprs)
 
-        def dofloat(ex):
-            if isinstance(ex, str):
-                return ex
-            else: return round(float(ex), self.print_expr_digs)
-
-        for i in range(len(self.branches)):
-            branch = self.branches[i]
-
-            if len(exprs) == 1:
-                val = dofloat(exprs[0].c(branch))
-            else:
-                val = tuple([dofloat(expr.c(branch)) for expr in exprs])
-
-            if val not in values:
-                amplitudes[len(values)] = [branch["amp"]]
-                values.append(val)
-            else:
-                idx = values.index(val)
-                amplitudes[idx].append(branch["amp"])
+        amplitudes = {} # value -> amplitudes of branches with that value
+        for val, amp in zip(vals, amps):
+            if val in amplitudes: amplitudes[val].append(amp)
+            else: amplitudes[val] = [amp]
         s = []
-        idxs = list(range(len(values)))
-        idxs.sort(key=lambda i:values[i])
 
         def show_amp(a):
             r,phi = cmath.polar(a)
@@ -186,11 +202,11 @@ class Measure:
             return str(r)+"*e^(i*"+str(phi)+")"
 
         # print distribution
-        for i in idxs:
-            amps = ", ".join([show_amp(a) for a in amplitudes[i]])
-            if isinstance(values[i], tuple):
-                st = " ".join([str(x) for x in list(values[i])])
-            else: st = str(values[i])
+        for val in sorted(amplitudes.keys()):
+            amps = ", ".join([show_amp(a) for a in amplitudes[val]])
+            if isinstance(val, tuple):
+                st = " ".join([str(x) for x in list(val)])
+            else: st = str(val)
 
             s.append(st + " w.a. " + amps)
         print("\n".join(s))
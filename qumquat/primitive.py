@@ -1,8 +1,8 @@
 from .qvars import *
-import cmath, copy
+import cmath
 
 # primitive.py
-#  - had, cnot, qft
+#  - had, had_range, walsh, cnot, swap, qft, dft
 #  - oper
 #  - phase
 
@@ -14,108 +14,198 @@ class Primitive:
     def had(self, key, bit):
         if self.queue_action('had', key, bit): return
         self.assert_mutable(key)
+        self.focus(key, bit)
         bit = Expression(bit, self)
         if key.key in bit.keys: raise SyntaxError("Can't hadamard variable in bit depending on itself.")
 
-        def branchesEqual(b1, b2):
-            for key in b1.keys():
-                if key == "amp": continue
-                if b1[key] != b2[key]: return False
-            return True
+        cols = self.columns()
+        if cols is not None and self.had_columns(cols, key, bit): return
 
+        if len(bit.keys) == 0 and not bit.float and bit.c({}) >= -1:
+            self.walsh(key, [int(bit.c({}))])
+            return
+
+        # branches share the immutable values of other registers,
+        # and prune merges equal branches
+        idx = key.index()
         newbranches = []
-        def insert(branch):
-
-            for existingbranch in newbranches:
-                if branchesEqual(branch, existingbranch):
-                    existingbranch["amp"] += branch["amp"]
-                    return
-            newbranches.append(branch)
-
-        goodbranch = lambda b: all([ctrl.c(b) != 0 for ctrl in self.controls])
-        for branch in self.branches:
-            if not goodbranch(branch):
-                insert(branch)
-            else:
-                idx = bit.c(branch)
-                newbranch1 = copy.deepcopy(branch)
-                newbranch1["amp"] /= math.sqrt(2)
-                newbranch1[key.index()] = es_int(branch[key.index()])
-                newbranch1[key.index()][idx] = 0
-
-                newbranch2 = copy.deepcopy(branch)
-                newbranch2["amp"] /= math.sqrt(2)
-                newbranch2[key.index()] = es_int(branch[key.index()])
-                newbranch2[key.index()][idx] = 1
-
-                if branch[key.index()][idx] == 1:
-                    newbranch2["amp"] *= -1
-
-                insert(newbranch1)
-                insert(newbranch2)
+        for branch, good in zip(self.branch_list(), self.control_list()):
+            if not good:
+                newbranches.append(branch)
+                continue
+
+            b = bit.c(branch)
+            val = branch[idx]
+            amp = branch["amp"] / math.sqrt(2)
+
+            newbranch1 = dict(branch)
+            newbranch1["amp"] = amp
+            newbranch1[idx] = val.with_bit(b, 0)
+
+            newbranch2 = dict(branch)
+            newbranch2["amp"] = -amp if val[b] == 1 else amp
+            newbranch2[idx] = val.with_bit(b, 1)
+
+            newbranches += [newbranch1, newbranch2]
 
         self.branches = newbranches
-        self.prune()
+        self.lazy_prune()
 
 
     def had_inv(self, key, bit):
         self.had(key, bit)
 
+    # hadamard on each of the bits of key, in one pass
+    def had_range(self, key, bits):
+        if self.queue_action('had_range', key, bits): return
+        self.assert_mutable(key)
+        self.focus(key)
+
+        bits = list(bits)
+        if not all(isinstance(bit, int) for bit in bits):
+            for bit in bits: self.had(key, bit)
+            return
+        if any(bit < -1 for bit in bits): raise IndexError("Can't hadamard bit below -1.")
+
+        # two hadamards on the same bit cancel
+        bits = [bit for bit in dict.fromkeys(bits) if bits.count(bit) % 2 == 1]
+        if len(bits) == 0: return
+
+        cols = self.columns()
+        if cols is not None and self.walsh_columns(cols, key, bits): return
+        self.walsh(key, bits)
+
+    def had_range_inv(self, key, bits):
+        self.had_range(key, bits)
+
+    # Walsh-Hadamard transform on the given bits of key, for each group of branches
+    # equal apart from those bits. Bits are positions in (magnitude << 1) | sign bit,
+    # and patterns are numbered with bits[0] as the highest bit, so branches come
+    # out in the same order as with one hadamard after another.
+    def walsh(self, key, bits):
+        k = len(bits)
+        n = 2**k
+        pos = [bit+1 for bit in bits]
+        clear = ~sum(1 << p for p in pos)
+        spread = [sum(1 << pos[j] for j in range(k) if (s >> (k-1-j)) & 1) for s in range(n)]
+
+        idx = key.index()
+        newbranches = []
+        groups = {} # signature -> (branch, dense vector of amplitudes)
+        for branch, good in zip(self.branch_list(), self.control_list()):
+            if not good:
+                newbranches.append(branch)
+                continue
+
+            val = branch[idx]
+            enc = (val.mag << 1) | (1 if val.sign < 0 else 0)
+            sig = (enc & clear,) + tuple(sorted((r, v) for r, v in branch.items() if r not in ["amp", idx]))
+            if sig not in groups:
+                groups[sig] = (branch, [0]*n)
+                newbranches.append(sig)
+
+            pattern = sum(((enc >> pos[j]) & 1) << (k-1-j) for j in range(k))
+            groups[sig][1][pattern] += branch["amp"]
+
+        out = []
+        for item in newbranches:
+            if isinstance(item, dict):
+                out.append(item)
+                continue
+
+            branch, vec = groups[item]
+            h = 1
+            while h < n:
+                for i in range(0, n, 2*h):
+                    for j in range(i, i+h):
+                        vec[j], vec[j+h] = vec[j] + vec[j+h], vec[j] - vec[j+h]
+                h *= 2
+
+            norm = math.sqrt(n)
+            for pattern in range(n):
+                if vec[pattern] == 0: continue
+                newbranch = dict(branch)
+                enc = item[0] | spread[pattern]
+                newbranch[idx] = es_int.signed(-1 if enc & 1 else 1, enc >> 1)
+                newbranch["amp"] = vec[pattern] / norm
+                out.append(newbranch)
+
+        self.branches = out
+        self.lazy_prune()
+
 
     ######################################## QFT
 
     def qft(self, key, d, inverse=False):
         if self.queue_action('qft', key, d, inverse): return
         self.assert_mutable(key)
+        self.focus(key, d)
         d = Expression(d, self)
         if key.key in d.keys:
             raise SyntaxError("Can't modify target based on expression that depends on target.")
 
-        def branchesEqual(b1, b2):
-            for key in b1.keys():
-                if key == "amp": continue
-                if b1[key] != b2[key]: return False
-            return True
+        cols = self.columns()
+        if cols is not None and self.qft_columns(cols, key, d, inverse): return
 
+        # Branches equal apart from key, with the same d, the same sign and the same
+        # base = key - key % d become one dense vector indexed by key % d. The qft is
+        # a discrete fourier transform of each vector. Groups are written out where
+        # their first branch was, so the order is the same as one branch at a time.
+        idx = key.index()
         newbranches = []
-        def insert(branch):
-            for existingbranch in newbranches:
-                if branchesEqual(branch, existingbranch):
-                    existingbranch["amp"] += branch["amp"]
-                    return
-            newbranches.append(branch)
-
-        goodbranch = lambda b: all([ctrl.c(b) != 0 for ctrl in self.controls])
-        for branch in self.branches:
-            if not goodbranch(branch):
-                insert(branch)
-            else:
-                dval = d.c(branch)
-                if dval != int(dval) or int(dval) <= 1:
-                    raise ValueError("QFT must be over a positive integer")
-                base = branch[key.index()] - (branch[key.index()] % dval)
-                for i in range(int(dval)):
-                    newbranch = copy.deepcopy(branch)
-                    newbranch['amp'] *= 1/math.sqrt(dval)
-
-                    if inverse:
-                        newbranch['amp'] *= cmath.exp(-int(branch[key.index()])*i\
-                                *2j*math.pi/int(dval))
-                    else:
-                        newbranch['amp'] *= cmath.exp(int(branch[key.index()])*i\
-                                *2j*math.pi/int(dval))
-
-                    newbranch[key.index()] = es_int(i + base)
-                    newbranch[key.index()].sign = branch[key.index()].sign
-                    insert(newbranch)
-
-
-        self.branches = newbranches
-        self.prune()
+        groups = {} # signature -> (branch, dense vector of amplitudes)
+        for branch, good in zip(self.branch_list(), self.control_list()):
+            if not good:
+                newbranches.append(branch)
+                continue
+
+            dval = d.c(branch)
+            if dval != int(dval) or int(dval) <= 1:
+                raise ValueError("QFT must be over a positive integer")
+            dval = int(dval)
+
+            val = branch[idx]
+            base = int(val) - int(val) % dval
+            sig = (dval, base, val.sign) + tuple(sorted((r, v) for r, v in branch.items() if r not in ["amp", idx]))
+            if sig not in groups:
+                groups[sig] = (branch, [0]*dval)
+                newbranches.append(sig)
+            groups[sig][1][int(val) % dval] += branch["amp"]
+
+        out = []
+        for item in newbranches:
+            if isinstance(item, dict):
+                out.append(item)
+                continue
+
+            branch, vec = groups[item]
+            dval, base, sign = item[:3]
+            vec = self.dft(vec, inverse)
+            for i in range(dval):
+                if abs(vec[i]) <= self.thresh: continue
+                newbranch = dict(branch)
+                newbranch[idx] = es_int.signed(sign, abs(i + base))
+                newbranch["amp"] = vec[i]
+                out.append(newbranch)
+
+        self.branches = out
+        self.lazy_prune()
 
     def qft_inv(self, key, d, inverse=False):
         self.qft(key, d, inverse=(not inverse))
 
+    # sum_r vec[r] * e^(+-2 pi i r k / d) / sqrt(d) for each k, with numpy's fft if available
+    def dft(self, vec, inverse):
+        d = len(vec)
+        if batch.np is not None:
+            if inverse: return (batch.np.fft.fft(vec) / math.sqrt(d)).tolist()
+            return (batch.np.fft.ifft(vec) * math.sqrt(d)).tolist()
+
+        sign = -1 if inverse else 1
+        terms = [(r, vec[r]) for r in range(d) if vec[r] != 0]
+        return [sum(a*cmath.exp(sign*2j*math.pi*((r*k) % d)/d) for r, a in terms) / math.sqrt(d)
+                for k in range(d)]
+
 
     ######################################## Primitives
 
@@ -126,8 +216,21 @@ class Primitive:
         if key.key in expr.keys:
             raise SyntaxError("Can't modify target based on expression that depends on target.")
 
-        for branch in self.controlled_branches():
-            branch[key.index()] = do(branch)
+        # the classical branch may be consts, which can't be batched
+        branches = self.scalar(key, expr, do)
+        if branches is not None:
+            vals = [do.c(b) if isinstance(do, Expression) else do(b) for b in branches]
+        else:
+            self.focus(key, expr)
+            cols = self.columns()
+            if cols is not None and self.oper_columns(cols, key, do): return
+            branches = self.controlled_branches()
+
+            if isinstance(do, Expression): vals = self.int_values(do, branches)
+            else: vals = [do(branch) for branch in branches]
+
+        for branch, val in zip(branches, vals):
+            branch[key.index()] = val
 
     def oper_inv(self, key, expr, do, undo):
         self.oper(key, expr, undo, do)
@@ -136,8 +239,17 @@ class Primitive:
         if self.queue_action('phase', theta): return
         theta = Expression(theta, self)
 
-        for branch in self.controlled_branches():
-            branch['amp'] *= cmath.exp(1j*float(theta.c(branch)))
+        branches = self.scalar(theta, amp=True)
+        if branches is not None: vals = [float(theta.c(b)) for b in branches]
+        else:
+            self.focus(theta)
+            cols = self.columns()
+            if cols is not None and self.phase_columns(cols, theta): return
+            branches = self.controlled_branches()
+            vals = self.float_values(theta, branches)
+
+        for branch, val in zip(branches, vals):
+            branch['amp'] *= cmath.exp(1j*val)
 
     def phase_inv(self, theta):
         self.phase(-theta)
@@ -155,15 +267,54 @@ class Primitive:
         if key.key in idx1.keys or key.key in idx2.keys:
             raise SyntaxError("Can't modify target based on expression that depends on target.")
 
-        for branch in self.controlled_branches():
+        branches = self.scalar(key, idx1, idx2)
+        if branches is None:
+            self.focus(key, idx1, idx2)
+            cols = self.columns()
+            if cols is not None and self.cnot_columns(cols, key, idx1, idx2): return
+            branches = self.controlled_branches()
+
+        for branch in branches:
             v_idx1 = idx1.c(branch)
             v_idx2 = idx2.c(branch)
             if v_idx1 == v_idx2: raise ValueError("Can't perform CNOT from index to itself.")
             if branch[key.index()][v_idx1] == 1:
-                branch[key.index()][v_idx2] = 1 - branch[key.index()][v_idx2]
+                val = branch[key.index()]
+                branch[key.index()] = val.with_bit(v_idx2, 1 - val[v_idx2])
 
     def cnot_inv(self, key, idx1, idx2):
         self.cnot(key, idx1, idx2)
 
+    # Without controls, the keys trade registers. With controls, the
+    # values are exchanged on the controlled branches.
+    def swap(self, key1, key2):
+        if self.queue_action('swap', key1, key2): return
+        self.assert_mutable(key1)
+        self.assert_mutable(key2)
+
+        target1, target2 = key1.partner(), key2.partner()
+        if target1.key == target2.key: raise SyntaxError("Can't swap register with itself.")
+
+        if len(self.controls) == 0:
+            self.key_dict[target1.key], self.key_dict[target2.key] = \
+                    self.key_dict[target2.key], self.key_dict[target1.key]
+            return
+
+        branches = self.scalar(key1, key2)
+        if branches is None:
+            self.focus(key1, key2)
+            cols = self.columns()
+            if cols is not None:
+                self.swap_columns(cols, key1, key2)
+                return
+            branches = self.controlled_branches()
+
+        idx1, idx2 = key1.index(), key2.index()
+        for branch in branches:
+            branch[idx1], branch[idx2] = branch[idx2], branch[idx1]
+
+    def swap_inv(self, key1, key2):
+        self.swap(key1, key2)
+
 
 
@@ -1,20 +1,31 @@
 import math
 import inspect
+import weakref
+from . import batch, codegen
+from .batch import BatchError
 
 # explicitly signed int
+# es_ints are immutable, so registers can share them, and small values are interned.
 class es_int(object):
+    __slots__ = ["sign", "mag"]
 
-    def __init__(self, val):
-        if isinstance(val, es_int):
-            self.sign = val.sign
-            self.mag = val.mag
-        elif isinstance(val, int):
-            self.sign = -1 if val < 0 else 1
-            self.mag = abs(val)
-        elif isinstance(val, float):
-            self.sign = -1 if "-" in str(val) else 1
-            self.mag = int(abs(val))
-        else: raise TypeError
+    def __new__(cls, val):
+        if isinstance(val, es_int): return val
+        if isinstance(val, int):
+            if -interned < val < interned: return small[val]
+            return es_int.signed(-1 if val < 0 else 1, abs(val))
+        if isinstance(val, float):
+            return es_int.signed(-1 if math.copysign(1, val) < 0 else 1, int(abs(val)))
+        raise TypeError
+
+    # the es_int with the given sign and magnitude, which may be -0
+    @staticmethod
+    def signed(sign, mag):
+        if sign > 0 and mag < interned: return small[mag]
+        out = object.__new__(es_int)
+        out.sign = sign
+        out.mag = mag
+        return out
 
     def __add__(self, expr): return es_int(int(self) + int(expr))
     def __sub__(self, expr): return es_int(int(self) - int(expr))
@@ -57,47 +68,35 @@ class es_int(object):
     def __rxor__(self, expr): return self ^ expr
     def __ror__(self, expr): return self | expr
 
-    def __neg__(self):
-        out = es_int(self)
-        out.sign *= -1
-        return out
-    def __abs__(self): return es_int(self.mag)
+    def __neg__(self): return es_int.signed(-self.sign, self.mag)
+    def __abs__(self): return es_int.signed(1, self.mag)
 
     def __complex__(self): return complex(self.sign * self.mag)
     def __int__(self): return self.sign * self.mag
     def __float__(self): return float(self.sign * self.mag)
 
     # For example: for i in range(-1, len(x)): print(x)
-    def __len__(self):
-        i = 0
-        while 2**i <= self.mag: i += 1
-        return i
+    def __len__(self): return self.mag.bit_length()
 
     def __bool__(self):
         return self.mag > 0
 
     def __getitem__(self, index):
         if index == -1: # -1 is sign bit
-            return es_int(1 if self.sign == -1 else 0)
+            return small[1 if self.sign == -1 else 0]
         else:
-            return es_int(1 if (self.mag & (1 << index)) else 0)
+            return small[(self.mag >> int(index)) & 1]
 
-    def __setitem__(self, key, value):
+    # copy with bit key set to value
+    def with_bit(self, key, value):
         key = int(key)
         if key < -1: raise IndexError
 
-        if self[key] == (int(value) % 2): return
-        if key == -1:
-            self.sign *= -1
-            return
+        if self[key] == (int(value) % 2): return self
+        if key == -1: return -self
 
-        if self[key]:
-            self.mag -= 2**key
-            if self.mag < 0:
-                self.mag = abs(self.mag)
-                self.sign *= -1
-        else:
-            self.mag += 2**key
+        if self[key]: return es_int.signed(self.sign, self.mag - 2**key)
+        return es_int.signed(self.sign, self.mag + 2**key)
 
     def __repr__(self): return str(self)
     def __str__(self): return ("+" if self.sign > 0 else "-") + str(int(self.mag))
@@ -107,15 +106,38 @@ class es_int(object):
     def __gt__(self, expr): return int(self) > int(expr)
     def __ge__(self, expr): return int(self) >= int(expr)
 
+    # equal to ints with the same value, but -0 is only equal to -0
     def __eq__(self, expr):
-        expr = es_int(expr)
+        if not isinstance(expr, es_int):
+            if isinstance(expr, int): return self.mag == abs(expr) and (self.sign < 0) == (expr < 0)
+            if not isinstance(expr, float): return NotImplemented
+            expr = es_int(expr)
         return self.mag == expr.mag and self.sign == expr.sign
 
+    def __ne__(self, expr):
+        out = self.__eq__(expr)
+        if out is NotImplemented: return out
+        return not out
+
     def __round__(self): return self
 
-    # hashable
-    def __hash__(self):
-        return self.mag*2 + (1 if self.sign == 1 else 0)
+    # hashable, and hashes like the equal int (python hashes the returned int)
+    def __hash__(self): return self.sign*self.mag
+
+    # immutable, so copies can be the same object
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
+    def __reduce__(self): return (es_int.signed, (self.sign, self.mag))
+
+# values -interned < v < interned are only created once
+def small_value(v):
+    out = object.__new__(es_int)
+    out.sign = -1 if v < 0 else 1
+    out.mag = abs(v)
+    return out
+
+interned = 1025
+small = {v:small_value(v) for v in range(-interned+1, interned)}
 
 
 #####################################
@@ -131,6 +153,21 @@ def irrevError(x, cond, path):
     if cond: raise IrrevError("Specified operation is not reversible. ("+path+")")
     return x
 
+# expression for x that raises an IrrevError wherever cond is true
+def irrevExpr(x, cond, path):
+    newexpr = Expression(x)
+    newexpr.keys = x.keys | cond.keys
+    newexpr.c = lambda b: irrevError(x.c(b), cond.c(b), path)
+    newexpr.tree = None
+
+    def v(cols):
+        out = x.v(cols)
+        irrevError(None, ((cond.v(cols) >> 1) != 0).any(), path)
+        return out
+
+    newexpr.v = None if x.v is None or cond.v is None else v
+    return newexpr
+
 ####################################
 
 class Key():
@@ -142,6 +179,10 @@ class Key():
             self.key = qq.key_count
             qq.key_count += 1
             qq.key_dict[self.key] = None
+
+            # once this object is gone, nothing can allocate the key again
+            qq.live_keys.add(self.key)
+            weakref.finalize(self, qq.release_key, self.key).atexit = False
         else:
             self.key = val
         self.partnerCache = None
@@ -152,7 +193,7 @@ class Key():
         return "<Qumquat Key: "+str(self.key)+", "+status+">"
 
     def allocated(self):
-        return self.qq.key_dict[self.key] is not None
+        return self.qq.key_dict.get(self.key) is not None
 
     # for debug - print short identifying string
     def short(self):
@@ -262,16 +303,16 @@ class Key():
     def __iadd__(self, expr):
         expr = Expression(expr, self.qq)
         if expr.float: raise ValueError("Can't add float to register.")
-        do = lambda b: b[self.index()] + expr.c(b)
-        undo = lambda b: b[self.index()] - expr.c(b)
+        do = Expression(self) + expr
+        undo = Expression(self) - expr
         self.qq.oper(self, expr, do, undo)
         return self
 
     def __isub__(self, expr):
         expr = Expression(expr, self.qq)
         if expr.float: raise ValueError("Can't subtract float from register.")
-        do = lambda b: b[self.index()] - expr.c(b)
-        undo = lambda b: b[self.index()] + expr.c(b)
+        do = Expression(self) - expr
+        undo = Expression(self) + expr
         self.qq.oper(self, expr, do, undo)
         return self
 
@@ -279,8 +320,8 @@ class Key():
         path = callPath()
         expr = Expression(expr, self.qq)
         if expr.float: raise ValueError("Can't multiply register by float.")
-        do = lambda b: b[self.index()] * irrevError(expr.c(b), expr.c(b) == 0, path)
-        undo = lambda b: irrevError(b[self.index()] // expr.c(b), b[self.index()] % expr.c(b) != 0, path)
+        do = irrevExpr(Expression(self) * expr, expr == 0, path)
+        undo = irrevExpr(Expression(self) // expr, Expression(self) % expr != 0, path)
         self.qq.oper(self, expr, do, undo)
         return self
 
@@ -290,14 +331,14 @@ class Key():
     def __ifloordiv__(self, expr):
         path = callPath()
         expr = Expression(expr, self.qq)
-        do = lambda b: irrevError(b[self.index()] // expr.c(b), b[self.index()] % expr.c(b) != 0, path)
-        undo = lambda b: b[self.index()] * irrevError(expr.c(b), expr.c(b) == 0, path)
+        do = irrevExpr(Expression(self) // expr, Expression(self) % expr != 0, path)
+        undo = irrevExpr(Expression(self) * expr, expr == 0, path)
         self.qq.oper(self, expr, do, undo)
         return self
 
     def __ixor__(self, expr):
         expr = Expression(expr, self.qq)
-        do = lambda b: b[self.index()] ^ expr.c(b)
+        do = Expression(self) ^ expr
         self.qq.oper(self, expr, do, do)
         return self
 
@@ -331,8 +372,8 @@ class Key():
     def __ilshift__(self, expr):
         expr = Expression(expr, self.qq)
 
-        do = lambda b: b[self.index()] << expr.c(b)
-        undo = lambda b: b[self.index()] >> expr.c(b)
+        do = Expression(self) << expr
+        undo = Expression(self) >> expr
 
         self.qq.oper(self, expr, do, undo)
         return self
@@ -385,7 +426,8 @@ class Key():
         self.qq.qft(self, d)
 
     def had(self, idx):
-        self.qq.had(self, idx)
+        if isinstance(idx, (range, list, tuple)): self.qq.had_range(self, idx)
+        else: self.qq.had(self, idx)
 
     def cnot(self, idx1, idx2):
         self.qq.cnot(self, idx1, idx2)
@@ -421,18 +463,28 @@ class Key():
 
 # Holds onto lambda expressions that are functions of
 # quantum registers (which are always es_int). Can be either int or float.
+# c evaluates on one branch, v evaluates on the columns of many branches
+# at once (see batch.py), and is None if that is not possible.
+# tree is the expression as a tuple (name, float, *children), from which
+# c is compiled (see codegen.py). It is None for expressions without one.
 
 class Expression(object):
+    tree = None
+
     def __init__(self, val, qq=None):
         if isinstance(val, Expression):
             self.keys = val.keys
             self.c = val.c
+            self.v = val.v
+            self.tree = val.tree
             self.float = val.float
             qq = val.qq
 
         if isinstance(val, Key):
             self.keys = set([val.key])
             self.c = lambda b: b[val.index()]
+            self.v = lambda cols: cols.regs[val.index()]
+            self.tree = ("reg", False, val)
             self.float = False
             qq = val.qq
 
@@ -442,18 +494,38 @@ class Expression(object):
         if isinstance(val, int) or isinstance(val, es_int):
             self.keys = set([])
             self.c = lambda b: es_int(val)
+            self.v = lambda cols: batch.constant(es_int(val), len(cols))
+            self.tree = ("const", False, es_int(val))
             self.float = False
 
         if isinstance(val, float):
             self.keys = set([])
             self.c = lambda b: val
+            self.v = lambda cols: batch.constant(val, len(cols))
+            self.tree = ("const", True, val)
             self.float = True
 
         if not hasattr(self, "keys"):
             raise ValueError("Invalid expression of type " + str(type(val)))
 
+    # Evaluate on many branches at once, by default on all branches.
+    # Returns a numpy array of ints, or of floats for float expressions.
+    def values(self, branches=None):
+        return self.qq.expression_values(self, branches)
+
+    # private method: the tree of this expression, or an opaque leaf if it has none
+    def node(self):
+        if self.tree is None: return ("opaque", self.float, self)
+        return self.tree
+
+    # private method: make this the operation name applied to args,
+    # evaluated by a function compiled from the tree
+    def build(self, name, *args):
+        self.tree = (name, self.float) + tuple(arg.node() for arg in args)
+        self.c = codegen.compiled(self.tree)
+
     # private method
-    def op(self, expr, c, floatmode="inherit"):
+    def op(self, expr, name, floatmode="inherit"):
         # "inherit" -> is float if any parent is float
         # "always" -> always a float
         # "never" -> never a float
@@ -468,51 +540,62 @@ class Expression(object):
         if floatmode == "always": newexpr.float = True
         if floatmode == "never": newexpr.float = False
 
-        if newexpr.float:
-            newexpr.c = lambda b: c(float(self.c(b)), float(expr.c(b)))
+        newexpr.build(name, self, expr)
+
+        if self.v is None or expr.v is None:
+            newexpr.v = None
         else:
-            newexpr.c = lambda b: c(self.c(b), expr.c(b))
+            v = batch.binary(name)
+            newexpr.v = lambda cols: v(self.v(cols), self.float, expr.v(cols), expr.float, newexpr.float)
 
         return newexpr
 
-    def __add__(self, expr): return self.op(expr, lambda x,y: x+y)
-    def __sub__(self, expr): return self.op(expr, lambda x,y: x-y)
-    def __mul__(self, expr): return self.op(expr, lambda x,y: x*y)
+    # private method: batch version of a unary operation
+    def vunary(self, name):
+        if self.v is None: return None
+        v = batch.unary(name)
+        return lambda cols: v(self.v(cols), self.float)
+
+    def __add__(self, expr): return self.op(expr, "add")
+    def __sub__(self, expr): return self.op(expr, "sub")
+    def __mul__(self, expr): return self.op(expr, "mul")
 
     def __radd__(self, expr): return self + expr
     def __rsub__(self, expr): return -self + expr
     def __rmul__(self, expr): return self * expr
 
-    def __truediv__(self, expr): return self.op(expr, lambda x,y: x / y, "always")
-    def __floordiv__(self, expr): return self.op(expr, lambda x,y: x // y)
-    def __mod__(self, expr): return self.op(expr, lambda x,y: x % y)
+    def __truediv__(self, expr): return self.op(expr, "truediv", "always")
+    def __floordiv__(self, expr): return self.op(expr, "floordiv")
+    def __mod__(self, expr): return self.op(expr, "mod")
 
-    def __rtruediv__(self, expr): return self.op(expr, lambda x,y: y / x, "always")
-    def __rfloordiv__(self, expr): return self.op(expr, lambda x,y: y // x)
-    def __rmod__(self, expr): return self.op(expr, lambda x,y: y % x)
+    def __rtruediv__(self, expr): return self.op(expr, "rtruediv", "always")
+    def __rfloordiv__(self, expr): return self.op(expr, "rfloordiv")
+    def __rmod__(self, expr): return self.op(expr, "rmod")
 
-    def __pow__(self, expr): return self.op(expr, lambda x,y: x**y, "always")
+    def __pow__(self, expr): return self.op(expr, "pow", "always")
     def __rpow__(self, expr): return pow(Expression(expr, self.qq), self)
 
     def __neg__(self):
         newexpr = Expression(self)
-        newexpr.c = lambda b: -(self.c(b))
+        newexpr.build("neg", self)
+        newexpr.v = self.vunary("neg")
         return newexpr
     def __abs__(self):
         newexpr = Expression(self)
-        newexpr.c = lambda b: abs(self.c(b))
+        newexpr.build("abs", self)
+        newexpr.v = self.vunary("abs")
         return newexpr
 
     ######################### Bitwise operations
 
-    def __lshift__(self, expr): return self.op(expr, lambda x,y: x << y, "never")
-    def __rshift__(self, expr): return self.op(expr, lambda x,y: x >> y, "never")
-    def __and__(self, expr): return self.op(expr, lambda x,y: x & y, "never")
-    def __xor__(self, expr): return self.op(expr, lambda x,y: x ^ y, "never")
-    def __or__(self, expr): return self.op(expr, lambda x,y: x | y, "never")
+    def __lshift__(self, expr): return self.op(expr, "lshift", "never")
+    def __rshift__(self, expr): return self.op(expr, "rshift", "never")
+    def __and__(self, expr): return self.op(expr, "and", "never")
+    def __xor__(self, expr): return self.op(expr, "xor", "never")
+    def __or__(self, expr): return self.op(expr, "or", "never")
 
-    def __rlshift__(self, expr): return self.op(expr, lambda x,y: y << x, "never")
-    def __rrshift__(self, expr): return self.op(expr, lambda x,y: y >> x, "never")
+    def __rlshift__(self, expr): return self.op(expr, "rlshift", "never")
+    def __rrshift__(self, expr): return self.op(expr, "rrshift", "never")
     def __rand__(self, expr): return self & expr
     def __rxor__(self, expr): return self ^ expr
     def __ror__(self, expr): return self | expr
@@ -523,22 +606,21 @@ class Expression(object):
     def len(self):
         if self.float: raise TypeError("Bit representations of floats not supported.")
         newexpr = Expression(self)
-        newexpr.c = lambda b: es_int(len(self.c(b)))
         newexpr.float = False
+        newexpr.build("len", self)
+        newexpr.v = self.vunary("len")
         return newexpr
 
     def __getitem__(self, index):
         if self.float: raise TypeError("Bit representations of floats not supported.")
-        newexpr = self.op(index, lambda x,y: x[y], False)
-        newexpr.float = False
-        return newexpr
+        return self.op(index, "getitem", "never")
 
    ######################### Comparisons
 
     # should return int
-    def __lt__(self, expr): return self.op(expr, lambda x,y: es_int(x < y), "never")
-    def __le__(self, expr): return self.op(expr, lambda x,y: es_int(x <= y), "never")
-    def __gt__(self, expr): return self.op(expr, lambda x,y: es_int(x > y), "never")
-    def __ge__(self, expr): return self.op(expr, lambda x,y: es_int(x >= y), "never")
-    def __eq__(self, expr): return self.op(expr, lambda x,y: es_int(x == y), "never")
-    def __ne__(self, expr): return self.op(expr, lambda x,y: es_int(x != y), "never")
+    def __lt__(self, expr): return self.op(expr, "lt", "never")
+    def __le__(self, expr): return self.op(expr, "le", "never")
+    def __gt__(self, expr): return self.op(expr, "gt", "never")
+    def __ge__(self, expr): return self.op(expr, "ge", "never")
+    def __eq__(self, expr): return self.op(expr, "eq", "never")
+    def __ne__(self, expr): return self.op(expr, "ne", "never")
@@ -1,25 +1,30 @@
 from .qvars import *
+from .columns import encode, decode
+import zipfile, struct
+
+# rows of snapshot factors multiplied at a time
+snap_chunk = 2**16
 
 # snapshot.py
 #  - get_numpy
 #  - snap
-#  - fidelity
-#  - trace_dist
+#  - fidelity, trace_dist, snap_rows, snap_chunks
+#  - save_snapshot, load_snapshot, map_array
 
 
 class Snapshots:
 
     ################### Snapshots
 
-    def get_numpy(self):
+    def get_numpy(self, feature="snapshots"):
         try:
             import numpy as np
         except ImportError:
-            raise ImportError("Qumquat snapshots require numpy to be installed.")
+            raise ImportError("Qumquat "+feature+" require numpy to be installed.")
         return np
 
     def snap(self, *regs):
-        self.get_numpy()
+        np = self.get_numpy()
 
         # check that registers are not expressions
         idxs = []
@@ -27,116 +32,159 @@ class Snapshots:
             if not isinstance(reg, Key):
                 raise SyntaxError("Can only take snapshot of quantum register, not expression.")
             idxs.append(reg.index())
+        self.focus(*regs)
+        self.settle()
+
+        # The amplitudes form a matrix psi, with a row for each value of the
+        # registers and a column for each value of the other registers, which
+        # are traced out. The reduced density matrix is psi psi^dag, which is
+        # never built: snapshots keep psi.
+        keys = {}   # values of regs -> row
+        groups = {} # values of other registers -> column
+        rows, cols, amps = [], [], []
+        for branch in self.branch_list():
+            key = tuple(branch[idx] for idx in idxs)
+            rest = tuple(sorted((r, v) for r, v in branch.items() if r != "amp" and r not in idxs))
+            if key not in keys: keys[key] = len(keys)
+            if rest not in groups: groups[rest] = len(groups)
+            rows.append(keys[key])
+            cols.append(groups[rest])
+            amps.append(branch["amp"])
+
+        psi = np.zeros((len(keys), len(groups)), dtype=complex)
+        np.add.at(psi, (rows, cols), amps)
+
+        # keep at most one column per row: the eigenvectors of rho, scaled
+        if psi.shape[1] > psi.shape[0]:
+            eigvals, eigs = np.linalg.eigh(psi @ psi.conj().T)
+            keep = eigvals > self.thresh
+            psi = eigs[:, keep] * np.sqrt(eigvals[keep])
 
-        def branchesEqualNonIdxs(b1, b2):
-            for key in self.branches[b1].keys():
-                if key == "amp": continue
-                if key in idxs: continue
-                if self.branches[b1][key] != self.branches[b2][key]: return False
-            return True
-
-        def branchesEqualIdxs(b1, b2):
-            for idx in idxs:
-                if self.branches[b1][idx] != self.branches[b2][idx]:
-                    return False
-            return True
-
-        # sort branches into lists such that:
-        # each list element has different values for idxs
-        # each list element has the same value for non-idxs
-
-        to_save = [[]]
-        for branch in range(len(self.branches)):
-            i = 0
-            while i < len(to_save):
-                found = False
-
-                if len(to_save[i]) > 0 and not branchesEqualNonIdxs(to_save[i][0], branch):
-                    i += 1
-                    continue
-
-                for saved in to_save[i]:
-                    if branchesEqualIdxs(saved, branch):
-                        found = True
-                        break
-
-                if not found:
-                    to_save[i].append(branch)
-                    break
-
-                i += 1
+        return {
+                "num_idxs": len(idxs),
+                "keys": list(keys.keys()),
+                "psi": psi,
+            }
 
-            if i == len(to_save):
-                to_save.append([branch])
+    # pairs (i, j) of rows of the factors of two snapshots with the same key,
+    # with -1 for keys only one of them has
+    def snap_rows(self, snap1, snap2):
+        np = self.get_numpy()
 
-        # assemble density matrix
-        rho = {}
-        keys = []
+        if snap1["num_idxs"] != snap2["num_idxs"]:
+            raise ValueError("Snapshots are on different number of registers.")
 
-        for i in range(len(to_save)):
-            for j in range(len(to_save[i])):
-                for k in range(len(to_save[i])):
-                    key1, key2 = [], []
-                    for idx in idxs: key1.append(str(self.branches[to_save[i][j]][idx]))
-                    for idx in idxs: key2.append(str(self.branches[to_save[i][k]][idx]))
-                    key1, key2 = " ".join(key1), " ".join(key2)
+        index = {key:j for j, key in enumerate(snap2["keys"])}
+        rows = [(i, index.pop(key, -1)) for i, key in enumerate(snap1["keys"])]
+        rows += [(-1, j) for j in index.values()]
+        return np.array(rows, dtype=np.int64).reshape(-1, 2)
 
-                    if key1 not in keys: keys.append(key1)
-                    if key2 not in keys: keys.append(key2)
+    # The factors A and B of two snapshots as one matrix M = [A B], with a row
+    # for each key, a chunk of rows at a time. Memory-mapped factors are only
+    # read one chunk at a time.
+    def snap_chunks(self, snap1, snap2, rows):
+        np = self.get_numpy()
+        A, B = snap1["psi"], snap2["psi"]
 
-                    key = key1 + "x" + key2
+        for start in range(0, len(rows), snap_chunk):
+            i, j = rows[start:start+snap_chunk].T
+            M = np.zeros((len(i), A.shape[1] + B.shape[1]), dtype=complex)
+            M[i >= 0, :A.shape[1]] = A[i[i >= 0]]
+            M[j >= 0, A.shape[1]:] = B[j[j >= 0]]
+            yield M
 
-                    val = self.branches[to_save[i][j]]["amp"] * \
-                            self.branches[to_save[i][k]]["amp"].conjugate()
+    # For rho1 = A A^dag and rho2 = B B^dag, the fidelity is the sum of the
+    # singular values of A^dag B, which is only r1 x r2.
+    def fidelity(self, snap1, snap2):
+        np = self.get_numpy()
+        rows = self.snap_rows(snap1, snap2)
+        rows = rows[(rows >= 0).all(axis=1)] # only common keys contribute
 
-                    if key in rho: rho[key] += val
-                    else: rho[key] = val
+        r1 = snap1["psi"].shape[1]
+        overlap = np.zeros((r1, snap2["psi"].shape[1]), dtype=complex)
+        for M in self.snap_chunks(snap1, snap2, rows):
+            overlap += M[:, :r1].conj().T @ M[:, r1:]
 
-        return {
-                "num_idxs": len(idxs),
-                "keys": keys,
-                "rho": rho,
-            }
+        return float(np.linalg.svd(overlap, compute_uv=False).sum())
 
-    def fidelity(self, snap1, snap2):
+    # rho1 - rho2 = M J M^dag for M = [A B] and J = diag(1,..,1,-1,..,-1).
+    # With M = QR, its eigenvalues are those of R J R^dag, which is only r x r.
+    # R is updated one chunk of rows at a time.
+    def trace_dist(self, snap1, snap2):
         np = self.get_numpy()
+        rows = self.snap_rows(snap1, snap2)
 
-        if snap1["num_idxs"] != snap2["num_idxs"]:
-            raise ValueError("Snapshots are on different number of registers.")
+        r1, r2 = snap1["psi"].shape[1], snap2["psi"].shape[1]
+        R = np.zeros((0, r1 + r2), dtype=complex)
+        for M in self.snap_chunks(snap1, snap2, rows):
+            R = np.linalg.qr(np.concatenate([R, M]), mode="r")
+        if r1 + r2 == 0: return 0.0
 
-        keys = list(set(snap1["keys"]) | set(snap2["keys"]))
-        rho1 = np.zeros((len(keys),len(keys))).astype(complex)
-        rho2 = np.zeros((len(keys),len(keys))).astype(complex)
+        J = np.concatenate([np.ones(r1), -np.ones(r2)])
+        eigs = np.linalg.eigvalsh((R * J) @ R.conj().T)
+        return float(np.abs(eigs).sum()/2)
 
-        for key in snap1["rho"].keys():
-            key1, key2 = key.split("x")
-            rho1[keys.index(key1)][keys.index(key2)] += snap1["rho"][key]
+    ################### Snapshot files
 
-        for key in snap2["rho"].keys():
-            key1, key2 = key.split("x")
-            rho2[keys.index(key1)][keys.index(key2)] += snap2["rho"][key]
+    # An uncompressed npz file with the factor psi, the keys as an int array
+    # in the column encoding of columns.py, and num_idxs.
+    def save_snapshot(self, snap, path):
+        np = self.get_numpy()
 
-        eigvals, eigs = np.linalg.eigh(rho1)
-        sqrtrho1 = np.dot(np.dot(eigs, np.diag([np.sqrt(x) for x in eigvals])), eigs.conj().T)
-        eigvals = np.linalg.eigvalsh(np.dot(np.dot(sqrtrho1, rho2), sqrtrho1))
-        return float(np.real(np.sqrt(eigvals).sum()))
+        keys = np.array([[encode(val) for val in key] for key in snap["keys"]], dtype=np.int64)
+        with open(path, "wb") as f:
+            np.savez(f, psi=np.asarray(snap["psi"]),
+                    keys=keys.reshape(len(snap["keys"]), snap["num_idxs"]),
+                    num_idxs=np.array(snap["num_idxs"]))
 
-    def trace_dist(self, snap1, snap2):
+    # With mmap, psi is memory-mapped from the file rather than read, if
+    # map_array can map it. Other npz files with the same arrays, such as
+    # compressed ones, are read into memory.
+    def load_snapshot(self, path, mmap=True):
         np = self.get_numpy()
 
-        if snap1["num_idxs"] != snap2["num_idxs"]:
-            raise ValueError("Snapshots are on different number of registers.")
+        try: z = zipfile.ZipFile(path)
+        except zipfile.BadZipFile:
+            raise ValueError(str(path)+" is not a snapshot file: not an npz archive.")
 
-        keys = list(set(snap1["keys"]) | set(snap2["keys"]))
-        diff = np.zeros((len(keys),len(keys))).astype(complex)
+        arrays = {}
+        with z, open(path, "rb") as f:
+            names = sorted(info.filename for info in z.infolist())
+            if names != ["keys.npy", "num_idxs.npy", "psi.npy"]:
+                raise ValueError(str(path)+" is not a snapshot file: expected arrays keys, num_idxs and psi.")
 
-        for key in snap1["rho"].keys():
-            key1, key2 = key.split("x")
-            diff[keys.index(key1)][keys.index(key2)] += snap1["rho"][key]
+            for info in z.infolist():
+                name = info.filename[:-4] # strip .npy
+                array = self.map_array(f, info) if mmap and name == "psi" else None
+                if array is None:
+                    with z.open(info) as member:
+                        array = np.lib.format.read_array(member, allow_pickle=False)
+                arrays[name] = array
 
-        for key in snap2["rho"].keys():
-            key1, key2 = key.split("x")
-            diff[keys.index(key1)][keys.index(key2)] -= snap2["rho"][key]
+        return {
+                "num_idxs": int(arrays["num_idxs"]),
+                "keys": [tuple(decode(enc) for enc in row) for row in arrays["keys"].tolist()],
+                "psi": arrays["psi"],
+            }
 
-        eigs = np.linalg.eigvalsh(diff)
-        return float(np.real(sum([abs(x) for x in eigs])/2))
+    # memory-maps an npy entry of an open zip file, or returns None when the
+    # entry can't be mapped: it is compressed or encrypted, its npy header has
+    # a version other than 1.0 or 2.0, or it holds python objects.
+    def map_array(self, f, info):
+        np = self.get_numpy()
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 1: return None
+
+        # the array data follows the local file header and the npy header
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if header[:4] != b"PK\x03\x04": return None
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0): shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0): shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        else: return None
+        if dtype.hasobject: return None
+
+        return np.memmap(f.name, dtype=dtype, mode="r", shape=shape,
+                offset=f.tell(), order="F" if fortran else "C")
@@ -4,7 +4,6 @@ from .qvars import *
 #  - int, float, round, floor, ceil
 #  - trig, sqrt
 #  - qram
-#  - swap
 
 class Utils:
 
@@ -15,8 +14,9 @@ class Utils:
             if not isinstance(expr, Key): return int(expr)
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: es_int(expr.c(b))
         newexpr.float = False
+        newexpr.build("int", expr)
+        newexpr.v = expr.vunary("int")
         return newexpr
 
     def float(self, expr):
@@ -24,8 +24,9 @@ class Utils:
             if not isinstance(expr, Key): return float(expr)
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: float(expr.c(b))
         newexpr.float = True
+        newexpr.build("float", expr)
+        newexpr.v = expr.vunary("float")
         return newexpr
 
 ######################### Rounding
@@ -37,8 +38,9 @@ class Utils:
         if not expr.float: return expr
 
         newexpr = Expression(expr)
-        newexpr.c = lambda b: es_int(round(expr.c(b)))
         newexpr.float = False
+        newexpr.build("round", expr)
+        newexpr.v = expr.vunary("round")
         return newexpr
 
     def floor(self, expr):
@@ -48,8 +50,9 @@ class Utils:
         if not expr.float: return expr
 
         newexpr = Expression(expr)
-        newexpr.c = lambda b: es_int(math.floor(expr.c(b)))
         newexpr.float = False
+        newexpr.build("floor", expr)
+        newexpr.v = expr.vunary("floor")
         return newexpr
 
     def ceil(self, expr):
@@ -59,8 +62,9 @@ class Utils:
         if not expr.float: return expr
 
         newexpr = Expression(expr)
-        newexpr.c = lambda b: es_int(math.ceil(expr.c(b)))
         newexpr.float = False
+        newexpr.build("ceil", expr)
+        newexpr.v = expr.vunary("ceil")
         return newexpr
 
 
@@ -71,8 +75,9 @@ class Utils:
             if not isinstance(expr, Key): return math.sin(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.sin(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("sin", expr)
+        newexpr.v = expr.vunary("sin")
         return newexpr
 
     def cos(self, expr):
@@ -80,8 +85,9 @@ class Utils:
             if not isinstance(expr, Key): return math.cos(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.cos(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("cos", expr)
+        newexpr.v = expr.vunary("cos")
         return newexpr
 
     def tan(self, expr):
@@ -89,8 +95,9 @@ class Utils:
             if not isinstance(expr, Key): return math.tan(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.tan(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("tan", expr)
+        newexpr.v = expr.vunary("tan")
         return newexpr
 
     def asin(self, expr):
@@ -98,8 +105,9 @@ class Utils:
             if not isinstance(expr, Key): return math.asin(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.asin(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("asin", expr)
+        newexpr.v = expr.vunary("asin")
         return newexpr
 
     def acos(self, expr):
@@ -107,8 +115,9 @@ class Utils:
             if not isinstance(expr, Key): return math.acos(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.acos(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("acos", expr)
+        newexpr.v = expr.vunary("acos")
         return newexpr
 
     def atan(self, expr):
@@ -116,8 +125,9 @@ class Utils:
             if not isinstance(expr, Key): return math.atan(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.atan(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("atan", expr)
+        newexpr.v = expr.vunary("atan")
         return newexpr
 
     def sqrt(self, expr):
@@ -125,8 +135,9 @@ class Utils:
             if not isinstance(expr, Key): return math.sqrt(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.sqrt(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("sqrt", expr)
+        newexpr.v = expr.vunary("sqrt")
         return newexpr
 
     def exp(self, expr):
@@ -134,8 +145,9 @@ class Utils:
             if not isinstance(expr, Key): return math.exp(float(expr))
             expr = Expression(expr, qq=self)
         newexpr = Expression(expr)
-        newexpr.c = lambda b: math.exp(float(expr.c(b)))
         newexpr.float = True
+        newexpr.build("exp", expr)
+        newexpr.v = expr.vunary("exp")
         return newexpr
 
     ######################### QRAM
@@ -159,16 +171,12 @@ class Utils:
             casted_dict[key] = expr
 
         newexpr = Expression(index)
+        for expr in casted_dict.values(): newexpr.keys = newexpr.keys | expr.keys
         newexpr.c = lambda b: casted_dict[int(index.c(b))].c(b)
+        newexpr.tree = None
+        newexpr.v = None if index.v is None else \
+                lambda cols: batch.qram(index.v(cols), cols, casted_dict, isFloat)
         newexpr.float = isFloat
         return newexpr
 
-    ############ SWAP
-
-    def swap(self, key1, key2):
-        key1 -= key2 # a1 = a0-b0
-        key2 += key1 # b1 = b0+a1 = a0
-        key1 -= key2 # a2 = a1-b1 = -b0
-        key1 *= -1
-
 
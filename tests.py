@@ -479,6 +479,207 @@ def test_stateprep():
     x.clean([0,1])
 
 
+def test_backend():
+    print("backend")
+    qq.set_backend("numpy")
+
+    x = qq.reg(range(8))
+    y = qq.reg(0)
+    for i in range(3): y.had(i)
+    with qq.control(x > 2): y += x
+    x.qft(8)
+    qq.print(x)
+    qq.clear()
+
+    # bitwise operations on two floats fail as they do per branch
+    x = qq.reg(range(100))
+    try: qq.print((x / 2) & (x / 3))
+    except TypeError: print("no & on floats")
+    qq.clear()
+
+    qq.set_backend("python")
+
+def test_values():
+    print("values")
+    x = qq.reg(range(100))
+    print((x*x % 7).values()[:10], qq.sqrt(x).values()[:4])
+    y = qq.reg(0)
+    with qq.control(x % 2 == 1): y += x // 2
+    qq.print(y % 4)
+    qq.clear()
+
+    # the sign of a float is its sign bit, also in exponent notation
+    print(es_int(0.5**32).sign, es_int(1e-20).sign, es_int(-0.0).sign, es_int(-2.5))
+
+
+def test_had_range():
+    print("had_range")
+    x, y = qq.reg(0, [1,2])
+    x.had(range(-1, 3))
+    with qq.control(x == 1): y.had([3, 4])
+    qq.print(x, y)
+    qq.clear()
+
+
+def test_dist():
+    print("dist")
+    x = qq.reg(range(100))
+    values, probs = qq.dist(x % 7, top_k=3)
+    print(values, probs)
+    qq.print(x % 7, min_prob=0.144)
+    with qq.inv(): qq.print(x % 10, top_k=2)
+    qq.clear()
+
+
+def test_sample():
+    print("sample")
+    x = qq.reg({0:1, 1:2, 2:3})
+    print(qq.sample(x, shots=1000, seed=1))
+    print(qq.sample(x, x % 2, shots=10))
+    x.clean({0:1, 1:2, 2:3})
+
+
+def test_expect():
+    print("expect")
+    x = qq.reg(range(10))
+    print(qq.expect(x), qq.variance(x), qq.expect([x, x**2, qq.sqrt(x)]))
+    x.clean(range(10))
+
+
+def test_snapshot_file():
+    print("snapshot file")
+    import tempfile, os
+    x = qq.reg([-1,0,1])
+    snap1 = qq.snap(x)
+    path = os.path.join(tempfile.mkdtemp(), "snap.npz")
+    qq.save_snapshot(snap1, path)
+
+    y = qq.reg(x)
+    snap2 = qq.load_snapshot(path)
+    print(qq.fidelity(snap1, snap2), qq.trace_dist(snap2, qq.snap(x)))
+
+    # compressed files are read instead of memory-mapped
+    import numpy as np
+    path2 = os.path.join(os.path.dirname(path), "compressed.npz")
+    with np.load(path) as f: np.savez_compressed(path2, **f)
+    print(qq.fidelity(snap1, qq.load_snapshot(path2)))
+
+    np.savez(path, psi=np.zeros(3))
+    try: qq.load_snapshot(path)
+    except ValueError: print("not a snapshot file")
+    qq.clear()
+
+
+def test_lazy():
+    print("lazy")
+    qq.set_lazy(True, max_branches=100)
+    x = qq.reg(0)
+    for i in range(8): x.had(i)
+    for i in range(8): x.had(i)
+    qq.print(x)
+    x.clean(0)
+    qq.set_lazy(False)
+
+
+def test_budget():
+    print("budget")
+    qq.set_budget(max_branches=3)
+    x = qq.reg({0:1, 1:4, 2:4, 3:4})
+    qq.print(x)
+    print("discarded norm", qq.discarded_norm)
+    qq.set_budget()
+    try: qq.set_budget(max_branches=0)
+    except ValueError: print("budget keeps at least one branch")
+    qq.clear()
+
+
+def test_factorize():
+    print("factorize")
+    qq.set_factorize(True)
+    x = qq.reg(range(30))
+    y = qq.reg(range(20))
+    print(len(qq.branches))
+    qq.print(x % 3, y % 2)
+    with qq.control(x < 10): y += 1
+    print(len(qq.branches))
+    qq.set_factorize(False)
+    qq.clear()
+
+
+def test_consts():
+    print("consts")
+    x = qq.reg(range(100))
+    i, n = qq.reg(0, 5)
+    print(all(b[n.index()] == 5 for b in qq.branches))
+    for j in range(10): i += n
+    with qq.control(x < 50): i += 1
+    qq.print(i)
+    with qq.control(x < 50): i -= 1
+    i.clean(50)
+    n.clean(5)
+    x.clean(range(100))
+
+
+def test_classical():
+    print("classical")
+    x, l = qq.reg(27, 0)
+    for i in range(111):
+        tmp = qq.reg(x % 2)
+        with qq.control(tmp == 0): x //= 2
+        with qq.control(tmp == 1):
+            x *= 3
+            x += 1
+        with qq.control(x > 1): l += 1
+    qq.phase_pi(l % 2)
+    qq.print_amp(x, l)
+    qq.clear()
+
+    # evaluated directly, whatever the batch size
+    batch_size = qq.batch_size
+    qq.batch_size = 1
+    try:
+        x = qq.reg(3)
+        x += 2
+        qq.phase_pi(x / 10)
+        qq.print_amp(x)
+        x.clean(5)
+    finally: qq.batch_size = batch_size
+
+    # the first evaluation of an expression is interpreted and later ones
+    # are compiled, with the same result
+    x = qq.reg(7)
+    e = (-x * 3 + 1) // 2 + qq.int(x / 4) + qq.floor(qq.sqrt(x))
+    y = qq.reg(e)
+    qq.print(y)
+    y.clean(e)
+    x.clean(7)
+
+
+def test_reuse():
+    print("reuse")
+    x = qq.reg(range(4))
+    y = qq.reg(x)
+    y.clean(x)
+    reg_count, num_keys = qq.reg_count, len(qq.key_dict)
+    for i in range(100):
+        y = qq.reg(x)
+        y.clean(x)
+    print(qq.reg_count == reg_count, len(qq.key_dict) == num_keys)
+    x.clean(range(4))
+
+
+def test_swap():
+    print("swap")
+    x, y, c = qq.reg(range(4), [5, 7], [0, 1])
+    with qq.control(c): qq.swap(x, y)
+    qq.swap(x, y)
+    qq.print(x, y, c)
+    with qq.inv():
+        with qq.control(c): qq.swap(x, y)
+        qq.swap(x, y)
+    x.clean(range(4))
+    y.clean([5, 7])
+    c.clean([0, 1])
 
 
 if True:
@@ -503,4 +704,17 @@ if True:
     test_qram()
     test_condinit()
     test_stateprep()
-
+    test_backend()
+    test_values()
+    test_had_range()
+    test_dist()
+    test_sample()
+    test_expect()
+    test_snapshot_file()
+    test_lazy()
+    test_budget()
+    test_factorize()
+    test_consts()
+    test_classical()
+    test_reuse()
+    test_swap()